@@ -0,0 +1,55 @@
+from typing import List, Optional, Tuple
+import reference_log
+import time
+
+from pm4py.objects.log.obj import EventLog, Trace, Event
+from pm4py.objects.petri_net.obj import PetriNet, Marking
+from pm4py.algo.conformance.tokenreplay import algorithm as token_replay
+
+TRANSITION_RESULTS = ['activated_transitions', 'enabled_transitions_in_marking', 'transitions_with_problems']
+VALUE_RESULTS = ['trace_is_fit', 'trace_fitness', 'missing_tokens', 'consumed_tokens', 'remaining_tokens', 'produced_tokens']
+REPLAY_PARAMETERS = {token_replay.Variants.TOKEN_REPLAY.value.Parameters.SHOW_PROGRESS_BAR: False}
+
+
+def to_event_log(traces: List[Tuple[str, ...]]) -> EventLog:
+    """Build an event log directly from traces of activity names."""
+    return EventLog([Trace([Event({'concept:name': a}) for a in trace]) for trace in traces])
+
+
+def replay_traces(net: PetriNet, initial: Marking, final: Marking, traces: List[Tuple[str, ...]]) -> List[dict]:
+    """Token-replay traces on a Petri net. Module level, so it can be pickled and run in a process pool.
+    Transitions are returned as (label, name) and the reached marking as place names, as the elements don't pickle."""
+    results = []
+    for replay in token_replay.apply(to_event_log(traces), net, initial, final, parameters=REPLAY_PARAMETERS):
+        result = {key: replay[key] for key in VALUE_RESULTS}
+        for key in TRANSITION_RESULTS:
+            result[key] = [(t.label, t.name) for t in replay[key]]
+        result['reached_marking'] = [p.name for p in replay['reached_marking']]
+        results.append(result)
+    return results
+
+
+def replay_variants(net: PetriNet, initial: Marking, final: Marking, xes_file: str,
+                    sample_rate: float = 1, time_budget: float = 0, chunk_size: int = 100) -> Tuple[float, float]:
+    """Replay the variants of a reference XES log (see reference_log) once each, most frequent first, until they cover sample_rate of its
+    traces or time_budget seconds (0 = unlimited) have passed, but at least one chunk of variants. Returns the average
+    trace fitness of the covered traces and the fraction of traces that was covered.
+    Module level, so it can be pickled and run in a process pool."""
+    variants = reference_log.open_reference_log(xes_file)
+    total = variants.traces()
+    sampled, cumulative = 0, 0
+    while sampled < len(variants) and cumulative < total * sample_rate:
+        cumulative += variants.counts[sampled]
+        sampled += 1
+
+    deadline: Optional[float] = time.monotonic() + time_budget if time_budget > 0 else None
+    fitness, covered = 0.0, 0
+    for i in range(0, sampled, chunk_size):
+        if i > 0 and deadline is not None and time.monotonic() >= deadline:
+            break
+        chunk = list(variants.variants(i, min(i + chunk_size, sampled)))
+        log = to_event_log([v for v, _ in chunk])
+        for (_, count), replay in zip(chunk, token_replay.apply(log, net, initial, final, parameters=REPLAY_PARAMETERS)):
+            fitness += replay['trace_fitness'] * count
+            covered += count
+    return (fitness / covered if covered else 0.0), (covered / total if total else 0.0)
@@ -1,15 +1,61 @@
-from typing import List
+from typing import AsyncIterator, Deque, Dict, List, Optional
+from collections import deque
 
+from segment_store import SegmentEventStore
+from event_store import EventStore
 from mqtt_event import MqttEvent
+import metrics
 import logging
+import asyncio
 import httpx
+import time
 import json
 import os
 
+DB_BATCH_PATH = os.environ.get('DB_BATCH_PATH', '')  # Optional endpoint accepting a list of events in one request
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 20))
 
-def get_existing_event_logs(db_address: str) -> List[str]:
+client: Optional[httpx.AsyncClient] = None
+
+DB_REQUEST_SECONDS = metrics.Histogram('miner_db_request_seconds', 'Duration of DB requests.', ['operation'])
+DB_ERRORS = metrics.Counter('miner_db_errors_total', 'DB requests that failed or returned an error status.', ['operation'])
+DB_DROPPED_EVENTS = metrics.Counter('miner_db_dropped_events_total', 'Events that could not be persisted after retrying.')
+
+
+def get_client() -> httpx.AsyncClient:
+    """Get the HTTP client shared by all DB requests, which keeps connections to the DB service alive."""
+    global client
+    if client is None:
+        limits = httpx.Limits(max_connections=DB_MAX_CONNECTIONS, max_keepalive_connections=DB_MAX_CONNECTIONS)
+        client = httpx.AsyncClient(timeout=60, limits=limits)  # High timeout because the DB service might be idle
+    return client
+
+
+async def close_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+async def send(operation: str, method: str, url: str, **kwargs) -> httpx.Response:
+    """Send a request to the DB over the shared client, recording its duration and whether it failed."""
+    start = time.perf_counter()
+    try:
+        result = await get_client().request(method, url, **kwargs)
+    except Exception:
+        DB_ERRORS.inc(operation)
+        raise
+    finally:
+        DB_REQUEST_SECONDS.observe(time.perf_counter() - start, operation)
+    if not result.is_success:
+        DB_ERRORS.inc(operation)
+    return result
+
+
+async def get_existing_event_logs(db_address: str) -> List[str]:
     try:
-        events_result = httpx.get(db_address + '/events', timeout=60)  # High timeout because the DB service might be idle
+        events_result = await send('get_logs', 'GET', db_address + '/events')
         if events_result.is_success:
             logs = json.loads(events_result.text)
             logging.info(f'Existing event logs in database: {logs}')
@@ -21,12 +67,14 @@ def get_existing_event_logs(db_address: str) -> List[str]:
         return []
 
 
-def get_existing_events_of_event_log(db_address: str, event_log: str) -> List[MqttEvent]:
+async def get_existing_events_of_event_log(db_address: str, event_log: str, after_rowid: int, limit: int) -> List[dict]:
+    """Get a page of at most limit events of an event log, with a rowid greater than after_rowid.
+    Events are returned as plain rows, as validating each into an event object dominates loading large logs."""
     try:
-        result = httpx.get(db_address + f'/events/{event_log}')
+        result = await send('get_events', 'GET', db_address + f'/events/{event_log}', params={'after': after_rowid, 'limit': limit})
         if result.is_success:
-            events: List[MqttEvent] = json.loads(result.text, object_hook=lambda d: MqttEvent(**d))
-            logging.info(f'Loaded {len(events)} entries from DB for event log {event_log}')
+            events: List[dict] = json.loads(result.text)
+            logging.debug(f'Loaded {len(events)} entries after rowid {after_rowid} from DB for event log {event_log}')
             return events
         else:
             raise Exception(f'Couldn\'t load entries from DB for log {event_log}. Status: {result}')
@@ -35,10 +83,275 @@ def get_existing_events_of_event_log(db_address: str, event_log: str) -> List[Mq
         return []
 
 
-def add_event(db_address: str, event: MqttEvent):
+async def iterate_existing_events_of_event_log(db_address: str, event_log: str, page_size: int,
+                                               after_rowid: int = 0) -> AsyncIterator[List[dict]]:
+    """Page through all events of an event log in rowid order, yielding one page at a time."""
+    loaded = 0
+    while True:
+        page = await get_existing_events_of_event_log(db_address, event_log, after_rowid, page_size)
+        unpaged = len(page) > page_size  # The DB ignored the paging parameters and returned everything
+        page = [row for row in page if row.get('rowid') is None or row['rowid'] > after_rowid]
+        if not page:
+            break
+        page.sort(key=lambda row: row.get('rowid') or 0)
+        loaded += len(page)
+        yield page
+        if unpaged or len(page) < page_size or page[-1].get('rowid') is None:
+            break
+        after_rowid = page[-1]['rowid']
+    logging.info(f'Loaded {loaded} entries from DB for event log {event_log}')
+
+
+def set_rowids(events: List[MqttEvent], result: httpx.Response):
+    """Set the rowids the DB reported for added events: a list with a rowid, or an object with a rowid, per event,
+    or just one of them for a single event. The rowids of events stay unknown for other responses."""
     try:
-        result = httpx.post(db_address + '/events/add', json=event.to_dict(), headers={'X-Secret': os.environ['SECRET']})
+        rowids = result.json()
+    except ValueError:
+        return
+    if not isinstance(rowids, list):
+        rowids = [rowids]
+    if len(rowids) == len(events):
+        for event, rowid in zip(events, rowids):
+            if isinstance(rowid, dict):
+                rowid = rowid.get('rowid')
+            event.rowid = rowid if isinstance(rowid, int) and not isinstance(rowid, bool) else None
+
+
+async def add_event(db_address: str, event: MqttEvent) -> bool:
+    try:
+        result = await send('add_event', 'POST', db_address + '/events/add', json=event.to_dict(), headers={'X-Secret': os.environ['SECRET']})
         if not result.is_success:
-            raise Exception(f'Couldn\t add new event to DB. Status: {result}')
+            raise Exception(f'Couldn\'t add new event to DB. Status: {result}')
+        set_rowids([event], result)
+        return True
     except Exception as e:
         logging.error(e)
+        return False
+
+
+async def add_events(db_address: str, events: List[MqttEvent]) -> List[MqttEvent]:
+    """Add a batch of events to the DB, and return the events that could not be added.
+    Uses a single request if DB_BATCH_PATH is configured, otherwise one request per event, sent concurrently over at
+    most DB_MAX_CONNECTIONS connections. The DB then assigns rowids in the order the requests arrive, which may
+    differ from the order of the events, see RowidWatermark."""
+    if not DB_BATCH_PATH:
+        added = await asyncio.gather(*[add_event(db_address, e) for e in events])
+        return [e for e, success in zip(events, added) if not success]
+
+    try:
+        result = await send('add_events', 'POST', db_address + DB_BATCH_PATH, json=[e.to_dict() for e in events],
+                            headers={'X-Secret': os.environ['SECRET']})
+        if not result.is_success:
+            raise Exception(f'Couldn\'t add {len(events)} new events to DB. Status: {result}')
+        set_rowids(events, result)
+        return []
+    except Exception as e:
+        logging.error(e)
+        return events
+
+
+class HttpEventStore(EventStore):
+    """Event store backed by the external DB service at DB_ADDRESS."""
+    def __init__(self, db_address: str):
+        self.db_address = db_address
+
+    async def get_event_logs(self) -> List[str]:
+        return await get_existing_event_logs(self.db_address)
+
+    def iterate_events(self, log: str, page_size: int, after_rowid: int = 0) -> AsyncIterator[List[dict]]:
+        return iterate_existing_events_of_event_log(self.db_address, log, page_size, after_rowid=after_rowid)
+
+    async def add_events(self, events: List[MqttEvent]) -> List[MqttEvent]:
+        return await add_events(self.db_address, events)
+
+    async def close(self):
+        await close_client()
+
+
+class MirroredEventStore(EventStore):
+    """Event store that reads from and writes to a primary store, and also writes to a mirror. Events that can't be
+    written to the mirror are only logged, as retrying them would write them to the primary store again.
+    Added events get the rowids of the primary store."""
+    def __init__(self, primary: EventStore, mirror: EventStore):
+        self.primary = primary
+        self.mirror = mirror
+
+    async def get_event_logs(self) -> List[str]:
+        return await self.primary.get_event_logs()
+
+    def iterate_events(self, log: str, page_size: int, after_rowid: int = 0) -> AsyncIterator[List[dict]]:
+        return self.primary.iterate_events(log, page_size, after_rowid)
+
+    async def add_events(self, events: List[MqttEvent]) -> List[MqttEvent]:
+        mirrored = [event.copy(update={'rowid': None}) for event in events]
+        failed, mirror_failed = await asyncio.gather(self.primary.add_events(events), self.mirror.add_events(mirrored))
+        if mirror_failed:
+            logging.error(f'Couldn\'t mirror {len(mirror_failed)} events to the DB.')
+        return failed
+
+    async def close(self):
+        await self.primary.close()
+        await self.mirror.close()
+
+
+def create_event_store() -> EventStore:
+    """Create the event store selected by EVENT_STORE: 'http' (default) for the DB service at DB_ADDRESS, or 'segment'
+    for local segment files in EVENT_STORE_DIR, which are mirrored to the DB service if EVENT_STORE_MIRROR is True."""
+    if os.environ.get('EVENT_STORE', 'http') == 'segment':
+        store = SegmentEventStore()
+        if os.environ.get('EVENT_STORE_MIRROR', 'False') == 'True':
+            return MirroredEventStore(store, HttpEventStore(os.environ['DB_ADDRESS']))
+        return store
+    return HttpEventStore(os.environ['DB_ADDRESS'])
+
+
+class RowidWatermark:
+    """Tracks the rowid up to which the event store contains exactly the live events of a log that were ingested.
+    Live events are persisted and ingested in the order they were accepted, but events persisted concurrently may get
+    their rowids in a different order, so it is the highest rowid of the ingested events, once no persisted event
+    that wasn't ingested yet has a lower one. Rowids of persisted events are kept until the events were ingested."""
+    def __init__(self):
+        self.pending: Deque[Optional[int]] = deque()  # In the order of the events, -1 for dropped events
+        self.unpersisted = 0  # Ingested events that weren't persisted yet
+        self.rowid: Optional[int] = 0  # None if the store didn't report the rowid of the last ingested event
+
+    def persisted(self, rowid: Optional[int]):
+        if self.unpersisted:
+            self.unpersisted -= 1
+            self.advance(rowid)
+        else:
+            self.pending.append(rowid)
+
+    def dropped(self):
+        """Skip an event that couldn't be persisted, the event store doesn't contain it."""
+        if self.unpersisted:
+            self.unpersisted -= 1
+        else:
+            self.pending.append(-1)
+
+    def ingested(self, count: int):
+        persisted = min(count, len(self.pending))
+        for _ in range(persisted):
+            rowid = self.pending.popleft()
+            if rowid != -1:
+                self.advance(rowid)
+        self.unpersisted += count - persisted
+
+    def advance(self, rowid: Optional[int]):
+        if rowid is None or self.rowid is None:
+            self.rowid = rowid
+        else:
+            self.rowid = max(self.rowid, rowid)
+
+    def watermark(self) -> Optional[int]:
+        """Get the rowid up to which the event store contains exactly the ingested live events (0 if there are none),
+        or None while some of them weren't persisted yet, their rowid is unknown, or events that weren't ingested
+        yet got lower rowids."""
+        if self.unpersisted or self.rowid is None:
+            return None
+        if any(rowid is not None and 0 <= rowid < self.rowid for rowid in self.pending):
+            return None
+        return self.rowid
+
+
+class EventWriter:
+    """Write-behind buffer for persisting events. Events are flushed to the event store in batches, either when
+    the batch size is reached or when the flush interval has passed, and failed writes are retried in order.
+    At most max_buffered events are buffered, callers check is_full() before adding events. The rowids of the
+    persisted events are tracked per log, see RowidWatermark. The events of a held log are kept back until it is
+    released, so they aren't read back while the history of the log is loaded."""
+    def __init__(self, store: EventStore, batch_size: int = 500, flush_interval: float = 1, max_retries: int = 3,
+                 max_buffered: int = 100000):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.max_buffered = max_buffered
+        self.buffer: Deque[MqttEvent] = deque()
+        self.held: Dict[str, List[MqttEvent]] = {}  # Events of held logs, by log
+        self.watermarks: Dict[str, RowidWatermark] = {}
+        self.batch_ready: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stopping = False
+
+    def is_full(self) -> bool:
+        """Check whether the buffer reached max_buffered events, because the event store can't keep up."""
+        return self.buffered() >= self.max_buffered
+
+    def buffered(self) -> int:
+        """Get the number of events waiting to be persisted, including those of held logs."""
+        return len(self.buffer) + sum(len(events) for events in self.held.values())
+
+    def add(self, event: MqttEvent):
+        self.add_many([event])
+
+    def get_watermark(self, log: str) -> RowidWatermark:
+        if log not in self.watermarks:
+            self.watermarks[log] = RowidWatermark()
+        return self.watermarks[log]
+
+    def add_many(self, events: List[MqttEvent]):
+        """Queue events for persistence without waiting for the DB."""
+        if self.held:
+            for event in events:
+                held = self.held.get(event.source) if event.source is not None else None
+                (self.buffer if held is None else held).append(event)
+        else:
+            self.buffer.extend(events)
+        if self.batch_ready is not None and len(self.buffer) >= self.batch_size:
+            self.batch_ready.set()
+
+    def hold(self, log: str):
+        """Keep back the events of a log until it is released."""
+        self.held.setdefault(log, [])
+
+    def release(self, log: str):
+        """Queue the held events of a log for persistence, and stop holding its events."""
+        self.add_many(self.held.pop(log, []))
+
+    def start(self):
+        """Start flushing in the background. Must be called from within the running event loop."""
+        self.batch_ready = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.batch_ready.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.batch_ready.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write all buffered events to the DB, one batch at a time."""
+        while self.buffer:
+            events = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+            batch = events
+            for attempt in range(self.max_retries + 1):
+                batch = await self.store.add_events(batch)
+                if not batch:
+                    break
+                if attempt < self.max_retries:
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+            if batch:
+                DB_DROPPED_EVENTS.inc(amount=len(batch))
+                logging.error(f'Dropping {len(batch)} events that could not be added to DB after {self.max_retries} retries.')
+            dropped = {id(event) for event in batch}
+            for event in events:
+                if id(event) in dropped:
+                    self.get_watermark(event.source).dropped()
+                else:
+                    self.get_watermark(event.source).persisted(event.rowid)
+
+    async def stop(self):
+        """Stop the background flushing and drain the remaining buffered events."""
+        self.stopping = True
+        for log in list(self.held):
+            self.release(log)
+        if self.task is not None:
+            self.batch_ready.set()
+            await self.task
+            self.task = None
+        await self.flush()
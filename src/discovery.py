@@ -0,0 +1,85 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+import logging
+import math
+import os
+
+from pm4py.objects.petri_net.obj import PetriNet, Marking
+from pm4py.algo.discovery.inductive import algorithm as inductive_miner
+from pm4py.algo.discovery.heuristics.variants import classic as heuristics_miner
+from pm4py.objects.conversion.heuristics_net import converter as heuristics_converter
+from pm4py.objects.conversion.dfg import converter as dfg_converter
+from pm4py.objects.conversion.dfg.variants import to_petri_net_invisibles_no_duplicates as dfg_to_petri_net
+
+Dfg = Tuple[dict, dict, dict, dict]  # Directly-follows relations, activities, start and end activities, with counts
+
+
+def create_executor() -> Executor:
+    """Create the executor that runs model discovery outside of the event loop.
+    DISCOVERY_EXECUTOR selects a 'process' (default) or 'thread' pool, DISCOVERY_WORKERS its size (0 = CPU count)."""
+    workers = int(os.environ.get('DISCOVERY_WORKERS', 0)) or None
+    kind = os.environ.get('DISCOVERY_EXECUTOR', 'process')
+    logging.info(f'Using a {kind} pool with {workers or os.cpu_count()} workers for model discovery.')
+    if kind == 'thread':
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='discovery')
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+class DfgFilter:
+    """Frequency-based noise filter of a DFG: keeps the activities and directly-follows relations that occurred at
+    least a minimum number of times, and of those only the most frequent ones (0 = no limit)."""
+    def __init__(self, min_activity_count: float = 0, max_activities: int = 0, min_edge_count: float = 0, max_edges: int = 0):
+        self.min_activity_count = min_activity_count
+        self.max_activities = max_activities
+        self.min_edge_count = min_edge_count
+        self.max_edges = max_edges
+
+    def apply(self, dfg: dict, activities: dict, start_act: dict, end_act: dict) -> Dfg:
+        activities = most_frequent(activities, self.min_activity_count, self.max_activities)
+        dfg = most_frequent({(a, b): c for (a, b), c in dfg.items() if a in activities and b in activities},
+                            self.min_edge_count, self.max_edges)
+        return dfg, activities, {a: c for a, c in start_act.items() if a in activities}, \
+            {a: c for a, c in end_act.items() if a in activities}
+
+    def degraded(self, edges: int, level: int, factor: float) -> 'DfgFilter':
+        """Get a stronger filter for a retry of discovery, that keeps factor^level of the given number of edges."""
+        max_edges = max(1, math.ceil(edges * factor ** level))
+        return DfgFilter(self.min_activity_count, self.max_activities, self.min_edge_count,
+                         min(self.max_edges, max_edges) if self.max_edges else max_edges)
+
+
+def most_frequent(counts: dict, min_count: float, limit: int) -> dict:
+    kept = {k: c for k, c in counts.items() if c >= min_count}
+    if limit and len(kept) > limit:
+        kept = dict(sorted(kept.items(), key=lambda item: item[1], reverse=True)[:limit])
+    return kept
+
+
+def discover_imd(dfg: dict, activities: dict, start_act: dict, end_act: dict) -> Tuple[PetriNet, Marking, Marking]:
+    return inductive_miner.apply_dfg(dfg, start_act, end_act, activities, variant=inductive_miner.Variants.IMd)
+
+
+def discover_dfg_net(dfg: dict, activities: dict, start_act: dict, end_act: dict) -> Tuple[PetriNet, Marking, Marking]:
+    """Convert the DFG itself into a Petri net, with a place per activity, which is fast but allows all its paths."""
+    parameters = {dfg_to_petri_net.Parameters.START_ACTIVITIES: start_act, dfg_to_petri_net.Parameters.END_ACTIVITIES: end_act}
+    return dfg_converter.apply(dfg, parameters=parameters, variant=dfg_converter.Variants.VERSION_TO_PETRI_NET_INVISIBLES_NO_DUPLICATES)
+
+
+def discover_heuristics(dfg: dict, activities: dict, start_act: dict, end_act: dict) -> Tuple[PetriNet, Marking, Marking]:
+    heu_net = heuristics_miner.apply_heu_dfg(dfg, activities=list(activities), activities_occurrences=activities,
+                                             start_activities=start_act, end_activities=end_act)
+    return heuristics_converter.apply(heu_net)
+
+
+# Discovery engines by the name used in the DISCOVERY_ENGINE setting
+ENGINES: Dict[str, Callable[[dict, dict, dict, dict], Tuple[PetriNet, Marking, Marking]]] = {
+    'imd': discover_imd, 'dfg': discover_dfg_net, 'heuristics': discover_heuristics}
+
+
+def discover_petri_net(dfg: dict, activities: dict, start_act: dict, end_act: dict, engine: str = 'imd',
+                       dfg_filter: Optional[DfgFilter] = None) -> Tuple[PetriNet, Marking, Marking]:
+    """Discover a Petri net from a DFG snapshot with an engine of ENGINES, optionally filtering the DFG first.
+    Module level, so it can be pickled and run in a process pool."""
+    if dfg_filter is not None:
+        dfg, activities, start_act, end_act = dfg_filter.apply(dfg, activities, start_act, end_act)
+    return ENGINES[engine](dfg, activities, start_act, end_act)
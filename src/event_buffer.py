@@ -0,0 +1,95 @@
+from typing import Dict, Iterable, List, Optional
+from mqtt_event import MqttEvent
+from array import array
+
+import numpy as np
+import logging
+
+
+class EventBatch:
+    """Events in columns: timestamps, and cases and activities as codes into the batch's case and activity names.
+    Only the fields discovery needs are kept, in timestamp order."""
+    def __init__(self, timestamps: np.ndarray, cases: np.ndarray, case_names: List[str], activities: np.ndarray,
+                 activity_names: List[str], last_rowid: int = 0):
+        self.timestamps = timestamps
+        self.cases = cases
+        self.case_names = case_names
+        self.activities = activities
+        self.activity_names = activity_names
+        self.last_rowid = last_rowid
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+
+class EventBuffer:
+    """Columnar buffer of the events of a log that haven't been ingested yet. Timestamps are stored in a typed array,
+    cases and activities as interned integer codes, so buffered events don't keep per-event Python objects alive."""
+    def __init__(self):
+        self.activity_ids: Dict[str, int] = {}
+        self.activity_names: List[str] = []
+        self.reset()
+
+    def reset(self):
+        self.timestamps = array('d')
+        self.cases = array('q')
+        self.activities = array('q')
+        self.case_ids: Dict[str, int] = {}  # Cases are interned per batch, so their names don't accumulate
+        self.case_names: List[str] = []
+        self.last_rowid = 0
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def append(self, timestamp: float, case: str, activity: str, rowid: Optional[int] = None):
+        self.timestamps.append(timestamp)
+        case_id = self.case_ids.get(case)
+        if case_id is None:
+            case_id = self.case_ids[case] = len(self.case_names)
+            self.case_names.append(case)
+        self.cases.append(case_id)
+        activity_id = self.activity_ids.get(activity)
+        if activity_id is None:
+            activity_id = self.activity_ids[activity] = len(self.activity_names)
+            self.activity_names.append(activity)
+        self.activities.append(activity_id)
+        if rowid is not None and rowid > self.last_rowid:
+            self.last_rowid = rowid
+
+    def extend(self, events: Iterable[MqttEvent]):
+        for e in events:
+            self.append(e.timestamp, e.process, e.activity, e.rowid)
+
+    def extend_rows(self, rows: Iterable[dict]):
+        """Append events given as rows of the DB, without validating them into event objects. Rows without a valid
+        timestamp, process or activity are logged and skipped."""
+        for row in rows:
+            try:
+                timestamp, case, activity = float(row['timestamp']), str(row['process']), str(row['activity'])
+            except (ValueError, KeyError, TypeError) as e:
+                logging.error(f'Skipping an invalid event {row}: {e!r}')
+                continue
+            self.append(timestamp, case, activity, row.get('rowid'))
+
+    def take(self) -> Optional[EventBatch]:
+        """Remove all buffered events, and return them as a batch in timestamp order (or None if there are none)."""
+        if not self.timestamps:
+            return None
+        timestamps = np.frombuffer(self.timestamps, dtype=np.float64)
+        order = np.argsort(timestamps, kind='stable')
+        batch = EventBatch(timestamps[order], np.frombuffer(self.cases, dtype=np.int64)[order], self.case_names,
+                           np.frombuffer(self.activities, dtype=np.int64)[order], list(self.activity_names), self.last_rowid)
+        self.reset()
+        return batch
+
+
+def batch_from_events(events: Iterable[MqttEvent]) -> Optional[EventBatch]:
+    buffer = EventBuffer()
+    buffer.extend(events)
+    return buffer.take()
+
+
+def batch_from_rows(rows: Iterable[dict]) -> Optional[EventBatch]:
+    buffer = EventBuffer()
+    buffer.extend_rows(rows)
+    return buffer.take()
@@ -0,0 +1,23 @@
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, List
+from mqtt_event import MqttEvent
+
+
+class EventStore(ABC):
+    """Storage backend of the recorded events of all event logs. Events are read back as plain rows
+    (dicts with rowid, timestamp, process and activity), in rowid order."""
+    @abstractmethod
+    async def get_event_logs(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def iterate_events(self, log: str, page_size: int, after_rowid: int = 0) -> AsyncIterator[List[dict]]:
+        """Page through the events of a log with a rowid greater than after_rowid."""
+
+    @abstractmethod
+    async def add_events(self, events: List[MqttEvent]) -> List[MqttEvent]:
+        """Add events, possibly of multiple event logs, in order, and return the events that could not be added.
+        The rowids the store assigned to the added events are set on them, if the store reports them."""
+
+    async def close(self):
+        pass
@@ -0,0 +1,465 @@
+from typing import Deque, Dict, List, Optional, Sequence, Tuple, Union
+from event_buffer import EventBatch
+from mqtt_event import MqttEvent
+from collections import Counter, deque
+from threading import Lock
+import pandas as pd
+import numpy as np
+import itertools
+import logging
+import ast
+
+from pm4py import format_dataframe
+from pm4py.objects.conversion.log import converter
+from pm4py.streaming.stream.live_event_stream import LiveEventStream
+from pm4py.streaming.algo.discovery.dfg import algorithm as dfg_discovery
+
+# Ingest engines turn events into a streaming DFG. Both engines share the same interface:
+#  - append(events) / append_batch(batch): record a list of events, or a columnar batch of events
+#  - get(): the current (dfg, activities, start activities, end activities), like pm4py's streaming DFG discovery
+#  - version: counter that changes with every appended batch, or None if changes can't be tracked exactly
+#  - export_state() / import_state(state): the DFG state in an engine-independent form, for snapshots
+#  - evicted / count_open_cases(): number of cases evicted from and currently in the open case tracking
+
+
+def get_pm4py_stream(events: List[MqttEvent]):
+    """Convert a list of event to a Pandas DataFrame compatible with pm4py."""
+    if not events:
+        return None
+    return get_pm4py_stream_from_columns([e.timestamp for e in events], [e.process for e in events],
+                                         [e.activity for e in events])
+
+
+def get_pm4py_stream_from_columns(timestamps: Union[Sequence[float], np.ndarray], cases: Union[Sequence[str], np.ndarray],
+                                  activities: Union[Sequence[str], np.ndarray]):
+    log = pd.DataFrame({'timestamp': timestamps, 'process': cases, 'activity': activities})
+    log = log.sort_values(by='timestamp', kind='stable')
+    log = format_dataframe(log, case_id='process', activity_key='activity', timestamp_key='timestamp')
+    return converter.apply(log, variant=converter.Variants.TO_EVENT_STREAM)
+
+
+class LiveStreamEngine:
+    """pm4py's streaming DFG discovery, fed event by event through a LiveEventStream.
+    Its case dict is a pm4py ThreadSafeDict, whose values() takes the dict's non-reentrant lock twice and never
+    returns. Read it through len(), keys() or a dict() copy only."""
+    def __init__(self):
+        self.version: Optional[int] = None
+        self.evicted = 0
+        self.live_event_stream = LiveEventStream()
+        self.streaming_dfg = dfg_discovery.apply()
+        self.live_event_stream.register(self.streaming_dfg)
+        self.live_event_stream.start()
+
+    def append(self, events: List[MqttEvent]):
+        if events:
+            for event in get_pm4py_stream(events):
+                self.live_event_stream.append(event)
+
+    def append_batch(self, batch: EventBatch):
+        if len(batch):
+            stream = get_pm4py_stream_from_columns(batch.timestamps, np.asarray(batch.case_names)[batch.cases],
+                                                   np.asarray(batch.activity_names)[batch.activities])
+            for event in stream:
+                self.live_event_stream.append(event)
+
+    def get(self) -> Tuple[dict, dict, dict, dict]:
+        return self.streaming_dfg.get()
+
+    def count_open_cases(self) -> int:
+        return len(self.streaming_dfg.case_dict)
+
+    def export_state(self) -> Tuple[int, dict]:
+        """Get the number of processed events and the DFG state. Events still queued in the stream aren't included."""
+        dfg = self.streaming_dfg
+        with dfg._lock:  # Same lock the streaming DFG holds while processing an event
+            state: dict = {'cases': dict(dfg.case_dict), 'dfg': [[*ast.literal_eval(k), int(v)] for k, v in dfg.dfg.items()],
+                     'activities': {k: int(v) for k, v in dfg.activities.items()},
+                     'start_activities': {k: int(v) for k, v in dfg.start_activities.items()}}
+        state['end_activities'] = dict(Counter(state['cases'].values()))
+        return sum(state['activities'].values()), state
+
+    def import_state(self, state: dict):
+        dfg = self.streaming_dfg
+        with dfg._lock:
+            dfg.case_dict.update(state['cases'])
+            dfg.dfg.update({dfg.encode_tuple((a, b)): count for a, b, count in state['dfg']})
+            dfg.activities.update(state['activities'])
+            dfg.start_activities.update(state['start_activities'])
+
+
+class DfgAccumulator:
+    """Streaming DFG discovery that processes each batch of events in one vectorized pass.
+    Activities are interned as integer IDs, and the last activity of each open case links it across batches.
+    Open cases idle for longer than case_ttl (in event time), or the least recently active cases beyond
+    max_open_cases, are evicted. An evicted case counts as ended; if it reappears, it is counted as a new case."""
+    dtype: type = np.int64
+
+    def __init__(self, max_open_cases: int = 0, case_ttl: float = 0):
+        self.version = 0
+        self.processed = 0
+        self.evicted = 0
+        self.max_open_cases = max_open_cases
+        self.case_ttl = case_ttl
+        self.newest_timestamp: Optional[float] = None
+        self.lock = Lock()
+        self.activity_ids: Dict[str, int] = {}
+        self.activity_names: List[str] = []
+        self.activity_counts: np.ndarray = np.zeros(0, dtype=self.dtype)
+        self.start_counts: np.ndarray = np.zeros(0, dtype=self.dtype)
+        self.end_counts = np.zeros(0, dtype=np.int64)
+        self.edges: Dict[Tuple[int, int], Union[int, float]] = {}
+        self.open_cases: Dict[str, Tuple[int, float]] = {}  # Last activity ID and timestamp, least recent first
+
+    def append(self, events: List[MqttEvent]):
+        if events:
+            self.append_columns(np.fromiter((e.timestamp for e in events), dtype=np.float64, count=len(events)),
+                                [e.process for e in events], [e.activity for e in events])
+
+    def append_batch(self, batch: EventBatch):
+        """Record a columnar batch of events, translating its activity codes to the activity IDs of this DFG."""
+        if len(batch):
+            with self.lock:
+                ids = self.intern(batch.activity_names)
+                self.append_codes(batch.timestamps, batch.cases, batch.case_names, ids[batch.activities])
+
+    def intern(self, activities: Sequence[str]) -> np.ndarray:
+        """Get the IDs of a sequence of activities, registering new activities."""
+        names, inverse = np.unique(np.asarray(activities, dtype=str), return_inverse=True)
+        ids = np.empty(len(names), dtype=np.int64)
+        for i, name in enumerate(names.tolist()):
+            if name not in self.activity_ids:
+                self.activity_ids[name] = len(self.activity_names)
+                self.activity_names.append(name)
+            ids[i] = self.activity_ids[name]
+
+        grow = len(self.activity_names) - len(self.activity_counts)
+        if grow > 0:
+            self.activity_counts = np.concatenate([self.activity_counts, np.zeros(grow, dtype=self.dtype)])
+            self.start_counts = np.concatenate([self.start_counts, np.zeros(grow, dtype=self.dtype)])
+            self.end_counts = np.concatenate([self.end_counts, np.zeros(grow, dtype=np.int64)])
+        return ids[inverse.reshape(-1)]
+
+    def append_columns(self, timestamps: np.ndarray, cases: Sequence[str], activities: Sequence[str]):
+        """Record a batch of events, given as columns, in any order. Events of the same case are linked in timestamp order."""
+        n = len(activities)
+        if n == 0:
+            return
+
+        with self.lock:
+            codes = self.intern(activities)
+            case_names, case_index = np.unique(np.asarray(cases, dtype=str), return_inverse=True)
+            self.append_codes(np.asarray(timestamps, dtype=np.float64), case_index.reshape(-1), case_names.tolist(), codes)
+
+    def append_codes(self, timestamps: np.ndarray, case_index: np.ndarray, case_names: List[str], codes: np.ndarray):
+        """Record events given as timestamps, indices into case names, and activity IDs. Must hold the lock."""
+        n = len(codes)
+        size = len(self.activity_names)
+        order = np.lexsort((timestamps, case_index))
+        case_index, codes = case_index[order], codes[order]
+        timestamps = timestamps[order]
+        newest = float(timestamps.max())
+        self.newest_timestamp = newest if self.newest_timestamp is None else max(self.newest_timestamp, newest)
+
+        # Positions of the first and last event of each case within the batch
+        first = np.ones(n, dtype=bool)
+        first[1:] = case_index[1:] != case_index[:-1]
+        last = np.ones(n, dtype=bool)
+        last[:-1] = first[1:]
+
+        # Previous activity of each event in its case, possibly from an earlier batch, or -1 for a new case
+        previous = np.empty(n, dtype=np.int64)
+        previous[1:] = codes[:-1]
+        previous[first] = [self.open_cases.get(case_names[c], (-1, 0.0))[0] for c in case_index[first].tolist()]
+        continued = previous[first]
+        self.end_counts -= np.bincount(continued[continued >= 0], minlength=size)
+        self.end_counts += np.bincount(codes[last], minlength=size)
+
+        self.add_counts(codes, previous, self.event_weights(timestamps))
+        self.record(timestamps, codes, previous)
+
+        # Move the cases to the most recent end of the open cases, in the order of their last event
+        last_positions = np.flatnonzero(last)
+        last_positions = last_positions[np.argsort(timestamps[last_positions], kind='stable')]
+        for case, activity, timestamp in zip(case_index[last_positions].tolist(), codes[last_positions].tolist(),
+                                             timestamps[last_positions].tolist()):
+            self.open_cases.pop(case_names[case], None)
+            self.open_cases[case_names[case]] = (activity, timestamp)
+        self.expire()
+        self.evict_cases()
+
+        self.processed += n
+        self.version += 1
+
+    def event_weights(self, timestamps: np.ndarray) -> np.ndarray:
+        """Get the weight each event adds to the counts."""
+        return np.ones(len(timestamps), dtype=self.dtype)
+
+    def add_counts(self, codes: np.ndarray, previous: np.ndarray, weights: np.ndarray):
+        """Add weighted events to the activity, start activity and directly-follows counts. Negative weights remove them."""
+        size = len(self.activity_names)
+        started = previous < 0
+        self.activity_counts += np.bincount(codes, weights, minlength=size).astype(self.dtype)
+        self.start_counts += np.bincount(codes[started], weights[started], minlength=size).astype(self.dtype)
+
+        keys, index = np.unique(previous[~started] * size + codes[~started], return_inverse=True)
+        counts: np.ndarray = np.bincount(index.reshape(-1), weights[~started], minlength=len(keys)).astype(self.dtype)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            edge = (key // size, key % size)
+            count += self.edges.get(edge, 0)
+            if count > 0:
+                self.edges[edge] = count
+            else:
+                self.edges.pop(edge, None)
+
+    def record(self, timestamps: np.ndarray, codes: np.ndarray, previous: np.ndarray):
+        """Keep the events of a batch, if they have to be removed from the counts later."""
+        pass
+
+    def expire(self):
+        """Remove contributions that are no longer part of the model."""
+        pass
+
+    def evict_cases(self):
+        """Stop tracking open cases that have been idle for too long, or that exceed the maximum number of open cases."""
+        evicted = 0
+        if self.case_ttl > 0:
+            for case, (_, timestamp) in self.open_cases.items():
+                if timestamp >= self.newest_timestamp - self.case_ttl:
+                    break
+                evicted += 1
+        if self.max_open_cases > 0:
+            evicted = max(evicted, len(self.open_cases) - self.max_open_cases)
+        for case in list(itertools.islice(self.open_cases, evicted)):
+            self.end_case(*self.open_cases.pop(case))
+        self.evicted += evicted
+
+    def end_case(self, activity: int, timestamp: float):
+        """Keep the end of an evicted case, if it has to be removed from the end activities later."""
+        pass
+
+    def get(self) -> Tuple[dict, dict, dict, dict]:
+        with self.lock:
+            names = self.activity_names
+            activities = self.counts_by_name(self.activity_counts)
+            dfg = {(names[s], names[t]): count for (s, t), count in self.edges.items()
+                   if names[s] in activities and names[t] in activities}
+            start_act = {a: c for a, c in self.counts_by_name(self.start_counts).items() if a in activities}
+            end_act = {a: c for a, c in self.counts_by_name(self.end_counts).items() if a in activities}
+            return dfg, activities, start_act, end_act
+
+    def count_open_cases(self) -> int:
+        return len(self.open_cases)
+
+    def counts_by_name(self, counts: np.ndarray) -> Dict[str, int]:
+        return {self.activity_names[i]: count for i, count in enumerate(counts.tolist()) if count > 0}
+
+    def export_state(self) -> Tuple[int, dict]:
+        """Get the number of processed events and the DFG state."""
+        with self.lock:
+            return self.processed, self.state()
+
+    def state(self) -> dict:
+        names = self.activity_names
+        return {'cases': {case: names[a] for case, (a, _) in self.open_cases.items()},
+                'case_timestamps': {case: timestamp for case, (_, timestamp) in self.open_cases.items()},
+                'dfg': [[names[s], names[t], count] for (s, t), count in self.edges.items()],
+                'activities': self.counts_by_name(self.activity_counts),
+                'start_activities': self.counts_by_name(self.start_counts),
+                'end_activities': self.counts_by_name(self.end_counts),
+                'newest_timestamp': self.newest_timestamp, 'processed': self.processed}
+
+    def import_state(self, state: dict):
+        with self.lock:
+            self.intern(list(state['activities']) + list(state['cases'].values()))
+            ids = self.activity_ids
+            for name, count in state['activities'].items():
+                self.activity_counts[ids[name]] += count
+            for name, count in state['start_activities'].items():
+                self.start_counts[ids[name]] += count
+            timestamps = state.get('case_timestamps', {})
+            for case, name in state['cases'].items():
+                self.open_cases[case] = (ids[name], timestamps.get(case, 0.0))
+            for name, count in state.get('end_activities', Counter(state['cases'].values())).items():
+                self.end_counts[ids[name]] += count
+            for source, target, count in state['dfg']:
+                self.edges[(ids[source], ids[target])] = self.edges.get((ids[source], ids[target]), 0) + count
+            self.newest_timestamp = state.get('newest_timestamp', max(timestamps.values(), default=None))
+            self.processed += state.get('processed', sum(state['activities'].values()))
+            self.version += 1
+
+
+class WindowedDfgAccumulator(DfgAccumulator):
+    """DFG discovery over a sliding window of the most recent events, either the last window_events events
+    or the events of the last window_seconds (in event time). Events leaving the window are subtracted from the
+    counts, and open cases without events in the window are closed, so the DFG stays bounded."""
+    def __init__(self, window_events: int = 0, window_seconds: float = 0, max_open_cases: int = 0, case_ttl: float = 0):
+        super().__init__(max_open_cases, case_ttl)
+        self.window_events = window_events
+        self.window_seconds = window_seconds
+        self.window: Deque[Tuple[np.ndarray, np.ndarray, np.ndarray]] = deque()  # Batches in order of timestamp
+        self.window_size = 0
+        self.ended_cases: Deque[Tuple[int, float]] = deque()  # Last activity and timestamp of evicted cases
+
+    def record(self, timestamps: np.ndarray, codes: np.ndarray, previous: np.ndarray):
+        order = np.argsort(timestamps, kind='stable')
+        self.window.append((timestamps[order], codes[order], previous[order]))
+        self.window_size += len(order)
+
+    def expire(self):
+        if self.window_seconds > 0:
+            horizon = self.newest_timestamp - self.window_seconds
+            while self.window and self.window[0][0][0] < horizon:
+                if not self.remove_from_window(int(np.searchsorted(self.window[0][0], horizon))):
+                    break
+        if self.window_events > 0:
+            while self.window_size > self.window_events:
+                self.remove_from_window(self.window_size - self.window_events)
+
+        # Close the open and evicted cases whose last event left the window, removing them from the end activities
+        horizon = self.window[0][0][0] if self.window else self.newest_timestamp
+        closed = []
+        for case, (activity, timestamp) in self.open_cases.items():
+            if timestamp >= horizon:
+                break
+            closed.append(case)
+            self.end_counts[activity] -= 1
+        for case in closed:
+            del self.open_cases[case]
+        while self.ended_cases and self.ended_cases[0][1] < horizon:
+            self.end_counts[self.ended_cases.popleft()[0]] -= 1
+
+    def end_case(self, activity: int, timestamp: float):
+        self.ended_cases.append((activity, timestamp))
+
+    def remove_from_window(self, count: int) -> bool:
+        """Subtract up to count events of the oldest batch in the window. Returns whether the whole batch was removed."""
+        timestamps, codes, previous = self.window[0]
+        count = min(count, len(timestamps))
+        self.add_counts(codes[:count], previous[:count], -self.event_weights(timestamps[:count]))
+        self.window_size -= count
+        if count == len(timestamps):
+            self.window.popleft()
+            return True
+        self.window[0] = (timestamps[count:], codes[count:], previous[count:])
+        return False
+
+    def state(self) -> dict:
+        names = self.activity_names
+        window = [[t, names[a], names[p] if p >= 0 else None] for timestamps, codes, previous in self.window
+                  for t, a, p in zip(timestamps.tolist(), codes.tolist(), previous.tolist())]
+        ended_cases = [[names[a], t] for a, t in self.ended_cases]
+        return {**super().state(), 'window': window, 'ended_cases': ended_cases}
+
+    def import_state(self, state: dict):
+        super().import_state(state)
+        with self.lock:
+            window = state.get('window', [])
+            if window:
+                ids = self.activity_ids
+                self.window.append((np.asarray([t for t, _, _ in window], dtype=np.float64),
+                                    np.asarray([ids[a] for _, a, _ in window], dtype=np.int64),
+                                    np.asarray([ids[p] if p is not None else -1 for _, _, p in window], dtype=np.int64)))
+                self.window_size += len(window)
+            ended_cases = state.get('ended_cases', [])
+            if ended_cases:
+                codes = self.intern([a for a, _ in ended_cases])
+                self.ended_cases.extend(zip(codes.tolist(), [t for _, t in ended_cases]))
+
+
+class DecayedDfgAccumulator(DfgAccumulator):
+    """DFG discovery with exponentially time-decayed counts: the weight of an event halves every half_life
+    seconds (in event time), and the end of a case, open or evicted, decays from its last event. Counts are rounded,
+    and edges and activities that decayed to zero are dropped."""
+    dtype: type = np.float64
+
+    def __init__(self, half_life: float, max_open_cases: int = 0, case_ttl: float = 0):
+        super().__init__(max_open_cases, case_ttl)
+        self.half_life = half_life
+        self.reference: Optional[float] = None  # Timestamp at which an event has weight 1
+        self.ended_counts = np.zeros(0, dtype=np.float64)  # Decayed end activities of evicted cases
+
+    def intern(self, activities: Sequence[str]) -> np.ndarray:
+        ids = super().intern(activities)
+        grow = len(self.activity_names) - len(self.ended_counts)
+        if grow > 0:
+            self.ended_counts = np.concatenate([self.ended_counts, np.zeros(grow, dtype=np.float64)])
+        return ids
+
+    def event_weights(self, timestamps: np.ndarray) -> np.ndarray:
+        # Weights grow with the timestamp instead of decaying all counts on every batch, see rescale()
+        newest = float(timestamps.max())
+        if self.reference is None:
+            self.reference = newest
+        elif newest - self.reference > 32 * self.half_life:
+            self.rescale(newest)
+        return np.exp2((timestamps - self.reference) / self.half_life)
+
+    def rescale(self, reference: float):
+        """Move the reference timestamp, decaying all counts accordingly and dropping edges that decayed away."""
+        factor = 2 ** ((self.reference - reference) / self.half_life) if self.reference is not None else 1.0
+        self.activity_counts *= factor
+        self.start_counts *= factor
+        self.ended_counts *= factor
+        self.edges = {edge: count * factor for edge, count in self.edges.items() if count * factor >= 0.5}
+        self.reference = reference
+
+    def get(self) -> Tuple[dict, dict, dict, dict]:
+        with self.lock:
+            if self.newest_timestamp is not None:
+                self.rescale(self.newest_timestamp)
+            activities = self.counts_by_name(self.activity_counts)
+            names = self.activity_names
+            dfg = {(names[s], names[t]): round(count) for (s, t), count in self.edges.items()
+                   if round(count) > 0 and names[s] in activities and names[t] in activities}
+            start_act = {a: c for a, c in self.counts_by_name(self.start_counts).items() if a in activities}
+
+            # The end of a case decays from the time of its last event
+            end_counts = self.ended_counts.copy()
+            if self.open_cases:
+                ends, timestamps = zip(*self.open_cases.values())
+                end_counts += np.bincount(ends, np.exp2((np.asarray(timestamps) - self.reference) / self.half_life),
+                                          minlength=len(names))
+            end_act = {a: c for a, c in self.counts_by_name(end_counts).items() if a in activities}
+            return dfg, activities, start_act, end_act
+
+    def end_case(self, activity: int, timestamp: float):
+        if self.reference is not None:  # Set by the events of the case
+            self.ended_counts[activity] += 2 ** ((timestamp - self.reference) / self.half_life)
+
+    def counts_by_name(self, counts: np.ndarray) -> Dict[str, int]:
+        return {self.activity_names[i]: round(count) for i, count in enumerate(counts.tolist()) if round(count) > 0}
+
+    def state(self) -> dict:
+        if self.newest_timestamp is not None:
+            self.rescale(self.newest_timestamp)
+        return {**super().state(), 'dfg': [[self.activity_names[s], self.activity_names[t], count]
+                                           for (s, t), count in self.edges.items()],
+                'activities': {name: float(self.activity_counts[i]) for name, i in self.activity_ids.items()},
+                'start_activities': {name: float(self.start_counts[i]) for name, i in self.activity_ids.items()},
+                'ended_activities': {name: float(self.ended_counts[i]) for name, i in self.activity_ids.items()}}
+
+    def import_state(self, state: dict):
+        super().import_state(state)
+        with self.lock:
+            self.reference = self.newest_timestamp
+            for name, count in state.get('ended_activities', {}).items():
+                self.ended_counts[self.activity_ids[name]] += count
+
+
+def create_ingest_engine(engine: str, max_open_cases: int = 0, case_ttl: float = 0, window: str = 'all',
+                         window_size: float = 0, half_life: float = 0):
+    """Create the ingest engine of a miner: 'native' for the vectorized DfgAccumulator (default),
+    or 'pm4py' for pm4py's streaming DFG discovery behind a LiveEventStream, which supports neither case eviction
+    nor windows. The window is one of 'all' (all events), 'count' or 'time' (a sliding window of window_size events
+    or seconds), or 'decay' (counts decayed with the given half life in seconds)."""
+    if engine == 'pm4py':
+        if window != 'all':
+            logging.warning(f'The pm4py ingest engine doesn\'t support "{window}" windows, using all events.')
+        return LiveStreamEngine()
+    if window == 'count':
+        return WindowedDfgAccumulator(window_events=int(window_size), max_open_cases=max_open_cases, case_ttl=case_ttl)
+    if window == 'time':
+        return WindowedDfgAccumulator(window_seconds=window_size, max_open_cases=max_open_cases, case_ttl=case_ttl)
+    if window == 'decay':
+        return DecayedDfgAccumulator(half_life, max_open_cases, case_ttl)
+    return DfgAccumulator(max_open_cases, case_ttl)
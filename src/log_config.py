@@ -0,0 +1,34 @@
+from typing import Dict, Optional, TypeVar
+import logging
+import json
+import os
+
+T = TypeVar('T', str, int, float, bool)
+
+log_config: Optional[Dict[str, dict]] = None
+
+
+def load_log_config() -> Dict[str, dict]:
+    """Load the per-log settings from the JSON file at LOG_CONFIG_FILE, e.g. {"my-log": {"MAX_OPEN_CASES": 1000}}."""
+    global log_config
+    if log_config is None:
+        file = os.environ.get('LOG_CONFIG_FILE', '../log-config.json')
+        log_config = {}
+        if os.path.exists(file):
+            try:
+                with open(file) as f:
+                    log_config = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f'Couldn\'t load log config {file}: {e}')
+    return log_config
+
+
+def get_log_setting(log: str, key: str, default: T) -> T:
+    """Get a setting for an event log from its entry in the log config file, falling back to the environment
+    variable with the same name, and then to the default. The value is converted to the type of the default."""
+    value = load_log_config().get(log, {}).get(key, os.environ.get(key))
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value if isinstance(value, bool) else str(value) == 'True'
+    return type(default)(value)
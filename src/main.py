@@ -1,25 +1,55 @@
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import RedirectResponse, JSONResponse
-from ws_connection_manager import ConnectionManager
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse, Response
+from ws_connection_manager import ConnectionManager, Message
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import ValidationError, parse_obj_as
 from fastapi_utils.tasks import repeat_every
 from custom_logging import CustomizeLogger
-from petri_net_state import PetriNetState
+from petri_net_state import Update, UpdateQueue
 from mqtt_event import MqttEvent
 from dotenv import load_dotenv
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from log_config import get_log_setting
+from event_buffer import EventBatch, EventBuffer
+from spill import SpillSegment
+from renderer import ModelRenderer
+from relay import UpdateRelay
+from pm4py.objects.petri_net.obj import PetriNet, Marking
 from miner import Miner
-from queue import Queue
+import conformance
+import event_buffer
 import db_helper
+import discovery
+import metrics
+import tracing
+import asyncio
 import logging
 import uvicorn
+import time
 import os
 
 load_dotenv()
 
+# 'embedded': this process mines and serves clients (single worker only), also as the miner process of web workers.
+# 'web': this process serves clients, forwarding requests to and relaying model updates from the miner process.
+MINER_MODE = os.environ.get('MINER_MODE', 'embedded')
+
 miners: Dict[str, Miner] = {}
-new_event_queue: Dict[str, Queue] = {}
-ws_updates_queue: Dict[str, Queue] = {}
+event_buffers: Dict[str, EventBuffer] = {}
+ws_updates_queue: Dict[str, UpdateQueue] = {}
+spills: Dict[str, SpillSegment] = {}  # Overflow segment per log, while events are spilled to disk
+backpressured: Set[str] = set()  # Logs whose ingest queue is above their high watermark
+hydration_status: Dict[str, str] = {}  # 'hydrating' while the history of a log is being loaded from the DB, then 'ready'
+listing_logs = False  # True at startup, until the logs with a history in the DB are known
+complete_updates: Dict[str, Tuple[int, Message]] = {}  # Encoded complete model per log, with its model version
+
+# Event-driven pipeline: logs with queued events are scheduled on the ingest queue, and ingesting events marks the
+# model of a log as outdated, which wakes up the model updater of that log
+ingest_queue: Optional[asyncio.Queue] = None
+ingest_scheduled: Set[str] = set()
+update_requested: Dict[str, asyncio.Event] = {}
+pipeline_tasks: List[asyncio.Task] = []
+xes_conformance_tasks: Dict[str, asyncio.Task] = {}
 
 
 def create_app() -> FastAPI:
@@ -32,22 +62,262 @@ def create_app() -> FastAPI:
 
 
 def add_event_to_queue(event: MqttEvent, log: str):
-    if log not in new_event_queue:
-        new_event_queue[log] = Queue()
-    new_event_queue[log].put(event)
+    add_events_to_queue([event], log)
+
+
+def add_events_to_queue(events: List[MqttEvent], log: str):
+    """Append events to the columnar buffer of a log, so only their interned fields are kept until ingestion.
+    Events of a backpressured log, and all events after them until they were drained, go to its spill segment."""
+    if log not in event_buffers:
+        event_buffers[log] = EventBuffer()
+    spill = spills.get(log)
+    if log in backpressured or (spill is not None and len(spill)):
+        if spill is None:
+            spill = spills[log] = SpillSegment(log)
+        spill.append(events)
+        SPILLED_EVENTS.inc(log, amount=len(events))
+    else:
+        event_buffers[log].extend(events)
+    schedule_ingest(log)
+
+
+def ingest_depth(log: str) -> int:
+    """Get the number of events of a log that are waiting for ingestion, in memory and spilled to disk."""
+    if log not in event_buffers:
+        return 0
+    spill = spills.get(log)
+    return len(event_buffers[log]) + (len(spill) if spill is not None else 0)
+
+
+def is_backpressured(log: str) -> bool:
+    """Check whether a log is backpressured: once INGEST_HIGH_WATERMARK events are waiting for its ingestion,
+    until they were ingested down to INGEST_LOW_WATERMARK."""
+    depth = ingest_depth(log)
+    if log in backpressured:
+        if depth <= get_log_setting(log, 'INGEST_LOW_WATERMARK', 50000):
+            backpressured.discard(log)
+            logging.info(f'Ingestion of "{log}" caught up, {depth} events are waiting.')
+    elif depth >= get_log_setting(log, 'INGEST_HIGH_WATERMARK', 100000):
+        backpressured.add(log)
+        logging.warning(f'Ingestion of "{log}" fell behind, {depth} events are waiting.')
+    return log in backpressured
+
+
+def check_backpressure(events_by_log: Dict[str, List[MqttEvent]]):
+    """Reject events with 429 if any of their logs is backpressured, and doesn't spill (INGEST_OVERFLOW=reject),
+    or if DB_MAX_BUFFERED events are waiting to be persisted already."""
+    if event_writer.is_full():
+        rejected, detail = list(events_by_log), 'Persisting events fell behind, retry later.'
+    else:
+        rejected = [log for log in events_by_log
+                    if is_backpressured(log) and get_log_setting(log, 'INGEST_OVERFLOW', 'reject') != 'spill']
+        detail = f'Ingestion of {", ".join(rejected)} fell behind, retry later.'
+    if rejected:
+        for log in rejected:
+            REJECTED_EVENTS.inc(log, amount=len(events_by_log[log]))
+        retry_after = max(get_log_setting(log, 'INGEST_RETRY_AFTER', 1) for log in rejected)
+        raise HTTPException(status_code=429, detail=detail, headers={'Retry-After': str(retry_after)})
+
+
+def persist_events(events: List[MqttEvent], logs: Iterable[str]):
+    """Queue events for persistence. While the logs with a history are listed at startup, the events of all logs
+    are held back, so they aren't loaded as history (see hydrate_event_log)."""
+    if listing_logs:
+        for log in logs:
+            event_writer.hold(log)
+    event_writer.add_many(events)
+
+
+def schedule_ingest(log: str):
+    """Wake up the ingest worker for a log with new events in its queue. Logs with events from before the pipeline
+    started are scheduled when it starts."""
+    if log not in ingest_scheduled and ingest_queue is not None:
+        ingest_scheduled.add(log)
+        ingest_queue.put_nowait(log)
+
+
+def request_update(log: str):
+    """Mark the model of a log as outdated, starting its model updater if it doesn't have one yet."""
+    if log not in update_requested:
+        update_requested[log] = asyncio.Event()
+        pipeline_tasks.append(asyncio.create_task(run_model_updates(log)))
+    update_requested[log].set()
+
+
+def verify_secret(request: Request):
+    if 'x-secret' not in request.headers.keys() or request.headers['x-secret'] != os.environ['SECRET']:
+        raise HTTPException(status_code=403, detail=f'Access denied. Secret did not match.')
+
 
+async def read_ndjson_events(request: Request) -> List[MqttEvent]:
+    """Parse a streamed body of newline-delimited JSON events, one line at a time."""
+    events: List[MqttEvent] = []
+    remainder = b''
+    line_number = 0
 
-def discover_existing_data():
-    """Query the database for existing event logs, get all of its data, and create a miner process for each event log."""
-    for log in db_helper.get_existing_event_logs(os.environ['DB_ADDRESS']):
-        events = db_helper.get_existing_events_of_event_log(os.environ['DB_ADDRESS'], log)
-        for event in events:
-            add_event_to_queue(event, log)
+    def parse_line(number: int, line: bytes):
+        if line.strip():
+            try:
+                events.append(MqttEvent.parse_raw(line))
+            except ValidationError as e:
+                raise HTTPException(status_code=400, detail=f'Invalid event on line {number}: {e}')
+
+    async for chunk in request.stream():
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        for line_number, line in enumerate(lines, start=line_number + 1):
+            parse_line(line_number, line)
+    parse_line(line_number + 1, remainder)
+    return events
+
+
+def latest_complete_update(log: str) -> Optional[Message]:
+    """Get the complete model of a log for a (re)synced WebSocket client, or None if there is none yet.
+    It is encoded once per model version, so many clients connecting at once share the same message."""
+    if relay is not None:
+        return relay.latest_complete_update(log)  # Otherwise sent by the relay once it is subscribed
+    if log not in miners:
+        return None
+    version = miners[log].model_version
+    if log not in complete_updates or complete_updates[log][0] != version:
+        complete_updates[log] = (version, Message(miners[log].latest_complete_update().to_json()))
+    return complete_updates[log][1]
 
 
 app: FastAPI = create_app()
-ws_manager = ConnectionManager()
-discover_existing_data()
+
+EVENTS_INGESTED = metrics.Counter('miner_events_ingested_total', 'Events appended to the DFG of a log.', ['log'])
+DISCOVERY_SECONDS = metrics.Histogram('miner_discovery_seconds', 'Duration of model discovery, including waiting for a worker.', ['log'])
+MODEL_UPDATES = metrics.Counter('miner_model_updates_total', 'Model updates broadcast to the clients of a log.', ['log'])
+UPDATE_ELEMENTS = metrics.Histogram('miner_update_elements', 'Places, transitions and edges added or removed by a model update.',
+                                    ['log'], buckets=metrics.SIZE_BUCKETS)
+DFG_ACTIVITIES = metrics.Gauge('miner_dfg_activities', 'Activities in the DFG of a log at its last model update.', ['log'])
+DFG_EDGES = metrics.Gauge('miner_dfg_edges', 'Directly-follows relations in the DFG of a log at its last model update.', ['log'])
+SPILLED_EVENTS = metrics.Counter('miner_spilled_events_total', 'Events of a log spilled to disk while it was backpressured.', ['log'])
+REJECTED_EVENTS = metrics.Counter('miner_rejected_events_total', 'Events of a log rejected while it was backpressured.', ['log'])
+MERGED_UPDATES = metrics.Counter('miner_merged_updates_total', 'Model updates merged into a pending update before broadcasting.', ['log'])
+DISCOVERY_DEGRADED = metrics.Counter('miner_discovery_degraded_total', 'Discoveries that exceeded the time budget of a log, '
+                                     'and were retried on a more strongly filtered DFG.', ['log'])
+DISCOVERY_LEVEL = metrics.Gauge('miner_discovery_level', 'How many times the DFG of the current model of a log was degraded.', ['log'])
+EVENT_LOOP_LAG = metrics.Histogram('miner_event_loop_lag_seconds', 'Delay of the event loop in running a scheduled callback.')
+metrics.Gauge('miner_recorded_events', 'Events recorded by the miner of a log.', ['log'],
+              collect=lambda: {(log,): miner.recorded for log, miner in list(miners.items())})
+metrics.Gauge('miner_open_cases', 'Cases tracked as open by the miner of a log.', ['log'],
+              collect=lambda: {(log,): miner.streaming_dfg.count_open_cases() for log, miner in list(miners.items())})
+metrics.Gauge('miner_event_queue_depth', 'Events queued for ingestion per log.', ['log'],
+              collect=lambda: {(log,): ingest_depth(log) for log in list(event_buffers)})
+metrics.Gauge('miner_spilled_event_depth', 'Events of a log waiting for ingestion in its spill segment on disk.', ['log'],
+              collect=lambda: {(log,): len(spill) for log, spill in list(spills.items())})
+metrics.Gauge('miner_ingest_backpressured', 'Whether the ingest queue of a log is above its high watermark.', ['log'],
+              collect=lambda: {(log,): int(log in backpressured) for log in list(event_buffers)})
+metrics.Gauge('miner_db_buffered_events', 'Events waiting to be persisted to the event store.',
+              collect=lambda: {(): event_writer.buffered()})
+metrics.Gauge('miner_update_queue_depth', 'Model updates queued for broadcasting per log.', ['log'],
+              collect=lambda: {(log,): queue.qsize() for log, queue in list(ws_updates_queue.items())})
+metrics.Gauge('miner_ws_clients', 'Connected WebSocket clients per log.', ['log'],
+              collect=lambda: {(log,): len(clients) for log, clients in list(ws_manager.connections.items())})
+ws_manager: ConnectionManager = ConnectionManager(latest_complete_update, send_timeout=float(os.environ.get('WS_SEND_TIMEOUT', 5)),
+                               max_queue=int(os.environ.get('WS_MAX_QUEUE', 32)),
+                               max_resyncs=int(os.environ.get('WS_MAX_RESYNCS', 3)))
+discovery_executor = discovery.create_executor()
+renderer = ModelRenderer(keep=int(os.environ.get('RENDER_KEEP', 10)), workers=int(os.environ.get('RENDER_WORKERS', 2)))
+event_store = db_helper.create_event_store()
+event_writer: db_helper.EventWriter = db_helper.EventWriter(event_store, batch_size=int(os.environ.get('DB_BATCH_SIZE', 500)),
+                                     flush_interval=float(os.environ.get('DB_FLUSH_INTERVAL', 1)),
+                                     max_retries=int(os.environ.get('DB_MAX_RETRIES', 3)),
+                                     max_buffered=int(os.environ.get('DB_MAX_BUFFERED', 100000)))
+relay = UpdateRelay(os.environ.get('MINER_ADDRESS', 'http://127.0.0.1:8002'), ws_manager) if MINER_MODE == 'web' else None
+
+
+hydration_task: Optional[asyncio.Task] = None
+
+
+def get_miner(log: str) -> Miner:
+    """Get the miner of a log, creating it (restored from its snapshot, if there is one) if it doesn't exist yet."""
+    if log not in miners:
+        ws_update_queue = UpdateQueue()
+        logging.info(f'Creating new miner for "{log}".')
+        miners[log] = Miner(log, ws_update_queue)
+        ws_updates_queue[log] = ws_update_queue
+    return miners[log]
+
+
+def append_batch_to_miner(log: str, batch: EventBatch):
+    """Append a batch of events to the miner of a log, creating the miner if it doesn't exist yet."""
+    logging.debug(f'Appending {len(batch)} new events for "{log}".')
+    get_miner(log).append_batch(batch)
+    EVENTS_INGESTED.inc(log, amount=len(batch))
+    request_update(log)
+
+
+async def discover_existing_data():
+    """Query the database for existing event logs, and page through their data concurrently, feeding each page
+    directly into the miner of its event log."""
+    global listing_logs
+    logs: List[str] = []
+    try:
+        logs = await event_store.get_event_logs()
+        for log in logs:
+            hydration_status[log] = 'hydrating'
+            event_writer.hold(log)
+    finally:
+        # Live events that arrived while listing the logs were held back, only those of logs with a history still are
+        listing_logs = False
+        for log in set(event_writer.held) - set(logs):
+            event_writer.release(log)
+            if log in event_buffers:
+                schedule_ingest(log)
+    semaphore = asyncio.Semaphore(int(os.environ.get('HYDRATION_CONCURRENCY', 4)))
+    await asyncio.gather(*[hydrate_event_log(log, semaphore) for log in logs])
+
+
+async def hydrate_event_log(log: str, semaphore: asyncio.Semaphore):
+    """Load the events of a log that aren't contained in the snapshot of its miner yet. Live events of the log are
+    neither persisted nor ingested until it is loaded, so the event store only contains its history meanwhile."""
+    async with semaphore:
+        try:
+            miner = get_miner(log)
+            async for page in event_store.iterate_events(log, int(os.environ.get('DB_PAGE_SIZE', 5000)),
+                                                         after_rowid=miner.last_rowid):
+                batch = event_buffer.batch_from_rows(page)
+                if batch is not None:
+                    append_batch_to_miner(log, batch)
+        finally:
+            hydration_status[log] = 'ready'
+            event_writer.release(log)
+            if log in event_buffers:
+                schedule_ingest(log)  # Live events that were held back during hydration
+
+
+@app.on_event('startup')
+async def start_hydration():
+    """Load existing data in the background, so the API is available immediately."""
+    global hydration_task, listing_logs
+    if relay is not None:
+        return
+    listing_logs = True
+    hydration_task = asyncio.create_task(discover_existing_data())
+
+
+@app.on_event('shutdown')
+async def stop_hydration():
+    if hydration_task is not None:
+        hydration_task.cancel()
+
+
+@app.on_event('startup')
+async def start_event_writer():
+    if relay is None:
+        event_writer.start()
+
+
+@app.on_event('shutdown')
+async def stop_event_writer():
+    """Drain the events that haven't been persisted yet, then close the event store."""
+    await event_writer.stop()
+    await event_store.close()
+    if relay is not None:
+        await relay.close()
 
 
 # REST API Part
@@ -59,98 +329,414 @@ async def root():
 
 
 @app.get('/logs')
-async def logs(request: Request):
-    """Gets a list of logs available to connect to via WebSockets"""
+async def logs(request: Request, status: bool = False):
+    """Gets a list of logs available to connect to via WebSockets.
+    With status=true, gets the loading status ('hydrating' or 'ready') of each log instead."""
+    if relay is not None:
+        return await relay.forward(request)
+    if status:
+        return JSONResponse({log: hydration_status.get(log, 'ready') for log in {**hydration_status, **miners}})
     return JSONResponse(list(miners.keys()))
 
 
+@app.get('/logs/{log}')
+async def log_stats(request: Request, log: str):
+    """Gets the loading status and ingest statistics of a log, such as its open and evicted cases."""
+    if relay is not None:
+        return await relay.forward(request)
+    if log not in miners.keys():
+        raise HTTPException(status_code=404, detail=f'No miner with name "{log}" found.')
+    return {'status': hydration_status.get(log, 'ready'), **miners[log].stats()}
+
+
+@app.get('/model/{log}.svg')
+async def model_svg(request: Request, log: str):
+    """Gets an SVG image of the current model of a log, rendered when it is first requested."""
+    return await model_file(request, log, 'svg', 'image/svg+xml')
+
+
+@app.get('/model/{log}.pnml')
+async def model_pnml(request: Request, log: str):
+    """Gets the current model of a log as a PNML file, exported when it is first requested."""
+    return await model_file(request, log, 'pnml', 'application/xml')
+
+
+async def model_file(request: Request, log: str, extension: str, media_type: str) -> Response:
+    if relay is not None:
+        return await relay.forward(request)
+    if log not in miners.keys():
+        raise HTTPException(status_code=404, detail=f'No miner with name "{log}" found.')
+    try:
+        path = await renderer.render(log, miners[log].current_model)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if path is None:
+        raise HTTPException(status_code=404, detail=f'No model has been discovered for "{log}" yet.')
+    with open(f'{path}.{extension}', 'rb') as f:
+        return Response(content=f.read(), media_type=media_type)
+
+
+@app.get('/metrics')
+async def get_metrics(request: Request):
+    """Gets the metrics of this process (of the miner process, with MINER_MODE=web) in the Prometheus text format."""
+    if relay is not None:
+        return await relay.forward(request)
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/metrics/worker')
+async def get_worker_metrics():
+    """Gets the metrics of this process in the Prometheus text format, also with MINER_MODE=web."""
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/admin/trace')
+async def get_trace(request: Request):
+    """Gets the most recent spans of the update pipeline in the Chrome trace event format (chrome://tracing, Perfetto)."""
+    verify_secret(request)
+    if relay is not None:
+        return await relay.forward(request)
+    return JSONResponse(tracing.chrome_trace())
+
+
+@app.get('/admin/profile')
+async def get_profile(request: Request, seconds: float = 10, interval: float = 0.005):
+    """Samples the stacks of this process for some seconds, and gets them in the collapsed format of flame graph tools."""
+    verify_secret(request)
+    if not 0 < seconds <= 300:
+        raise HTTPException(status_code=400, detail='Seconds must be between 0 and 300.')
+    if relay is not None:
+        return await relay.forward(request, timeout=seconds + 60)
+    try:
+        return PlainTextResponse(await asyncio.get_running_loop().run_in_executor(None, tracing.profile, seconds, interval))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@app.on_event('startup')
+@repeat_every(seconds=0.5, raise_exceptions=True)
+async def measure_event_loop_lag():
+    """Measure how late the event loop runs a callback that is due right away."""
+    start = time.perf_counter()
+    await asyncio.sleep(0)
+    EVENT_LOOP_LAG.observe(time.perf_counter() - start)
+
+
+@app.on_event('startup')
+@repeat_every(seconds=int(os.environ.get('SNAPSHOT_INTERVAL', 60)), wait_first=True, raise_exceptions=True)
+async def save_snapshots():
+    """Periodically checkpoint the DFG of each miner, so a restart only needs to replay newer events."""
+    if os.environ.get('SAVE_SNAPSHOTS', 'False') == 'True':
+        for log, miner in list(miners.items()):
+            watermark = snapshot_watermark(log)
+            if watermark is None:
+                logging.debug(f'Live events of "{log}" aren\'t persisted yet, skipping snapshot.')
+                continue
+            await asyncio.get_running_loop().run_in_executor(None, miner.save_snapshot, *watermark)
+
+
+@app.on_event('shutdown')
+def save_final_snapshots():
+    """Checkpoint the DFG of each miner, after the event writer persisted the remaining events."""
+    if os.environ.get('SAVE_SNAPSHOTS', 'False') == 'True':
+        for log, miner in miners.items():
+            watermark = snapshot_watermark(log)
+            if watermark is None:
+                logging.warning(f'Couldn\'t save a snapshot of "{log}", the event store didn\'t report the rowids of its events.')
+                continue
+            miner.save_snapshot(*watermark)
+
+
+def snapshot_watermark(log: str) -> Optional[Tuple[int, int]]:
+    """Get the number of events recorded by the miner of a log, and the rowid up to which the event store contains
+    exactly these events, or None while some of its live events weren't persisted yet."""
+    rowid = event_writer.get_watermark(log).watermark()
+    if rowid is None:
+        return None
+    return miners[log].recorded, max(miners[log].last_rowid, rowid)
+
+
 @app.post('/notify')
 async def notify(request: Request, event: MqttEvent):
     """Notify a miner of a new event, and create a new miner if the event log hasn't been encountered yet."""
-    if 'x-secret' not in request.headers.keys() or request.headers['x-secret'] != os.environ['SECRET']:
-        raise HTTPException(status_code=403, detail=f'Access denied. Secret did not match.')
+    verify_secret(request)
+    if relay is not None:
+        return await relay.forward(request)
 
     if not event.source:
         raise HTTPException(status_code=400, detail='Source value must be set.')
 
-    logging.info(f'Received new event notification: {event}')
-    db_helper.add_event(os.environ['DB_ADDRESS'], event)
+    check_backpressure({event.source: [event]})
+    logging.debug(f'Received new event notification: {event}')
+    persist_events([event], [event.source])
     add_event_to_queue(event, event.source)
 
 
+@app.post('/notify/batch')
+async def notify_batch(request: Request):
+    """Notify miners of a batch of new events, possibly of multiple event logs.
+    The body is either a JSON array of events, or newline-delimited JSON (Content-Type: application/x-ndjson)."""
+    verify_secret(request)
+    if relay is not None:
+        return await relay.forward(request)
+
+    if request.headers.get('content-type', '').startswith('application/x-ndjson'):
+        events = await read_ndjson_events(request)
+    else:
+        try:
+            events = parse_obj_as(List[MqttEvent], await request.json())
+        except (ValueError, ValidationError) as e:
+            raise HTTPException(status_code=400, detail=f'Invalid batch of events: {e}')
+
+    by_source: Dict[str, List[MqttEvent]] = {}
+    for event in events:
+        if not event.source:
+            raise HTTPException(status_code=400, detail='Source value must be set for every event.')
+        by_source.setdefault(event.source, []).append(event)
+
+    check_backpressure(by_source)
+    logging.info(f'Received batch of {len(events)} new events for {len(by_source)} event logs.')
+    persist_events(events, by_source)
+    for source, source_events in by_source.items():
+        add_events_to_queue(source_events, source)
+    return {source: len(source_events) for source, source_events in by_source.items()}
+
+
 @app.post('/conformance/{log}')
 async def conformance_check(request: Request, log: str, events: List[str]):
+    """Replay a trace of activities on the current model of a log."""
+    if relay is not None:
+        return await relay.forward(request)
+    return (await replay_traces(log, [events]))[0]
+
+
+@app.post('/conformance/{log}/batch')
+async def conformance_check_batch(request: Request, log: str, traces: List[List[str]]):
+    """Replay many traces of activities on the current model of a log, with one result per trace."""
+    if relay is not None:
+        return await relay.forward(request)
+    return await replay_traces(log, traces)
+
+
+async def replay_traces(log: str, traces: List[List[str]]) -> List[dict]:
+    """Replay traces on the current model of a log. Each distinct trace is replayed once per model, in the
+    discovery executor, and its result is cached with the IDs of that model's elements."""
     if log not in miners.keys():
         raise HTTPException(status_code=404, detail=f'No miner with name "{log}" found.')
+    miner = miners[log]
+    model = miner.current_model()
+    if model is None:
+        raise HTTPException(status_code=409, detail=f'No model has been discovered for "{log}" yet.')
+    _, model_version, petri_net = model
+    ids = miner.element_ids()  # The model may change while replaying
+
+    results: Dict[Tuple[str, ...], dict] = {}
+    missing: List[Tuple[str, ...]] = []
+    for trace in dict.fromkeys(map(tuple, traces)):
+        cached = miner.cached_replay(model_version, trace)
+        if cached is None:
+            missing.append(trace)
+        else:
+            results[trace] = cached
+    if missing:
+        replayed = await asyncio.get_running_loop().run_in_executor(discovery_executor, conformance.replay_traces,
+                                                                    *petri_net, missing)
+        for trace, result in zip(missing, replayed):
+            results[trace] = Miner.replay_result_with_ids(result, ids)
+            miner.cache_replay(model_version, trace, results[trace])
+    return [results[tuple(trace)] for trace in traces]
 
-    replay = miners[log].conformance_check(events)[0]
 
-    def t_names(tr: List) -> List[str]:
-        return [miners[log].name_to_id(t.label) if t.label else t.name for t in tr]
+@app.on_event('startup')
+async def start_pipeline():
+    global ingest_queue
+    if relay is not None:
+        return
+    ingest_queue = asyncio.Queue()
+    pipeline_tasks.append(asyncio.create_task(append_new_events()))
+    for log in list(event_buffers):
+        schedule_ingest(log)
 
-    is_fit = 'trace_is_fit'
-    fitness = 'trace_fitness'
-    transitions = 'activated_transitions'
-    reached = 'reached_marking'
-    enabled = 'enabled_transitions_in_marking'
-    problems = 'transitions_with_problems'
-    missing = 'missing_tokens'
-    consumed = 'consumed_tokens'
-    remaining = 'remaining_tokens'
-    produced = 'produced_tokens'
-    return {is_fit: replay[is_fit], fitness: replay[fitness], transitions: t_names(replay[transitions]),
-            reached: [miners[log].name_to_id(m.name) for m in replay[reached]], enabled: t_names(replay[enabled]),
-            problems: t_names(replay[problems]), missing: replay[missing], consumed: replay[consumed],
-            remaining: replay[remaining], produced: replay[produced]}
+
+@app.on_event('shutdown')
+async def stop_pipeline():
+    for task in pipeline_tasks:
+        task.cancel()
+    for spill in spills.values():
+        spill.close()
 
 
-@app.on_event('startup')
-@repeat_every(seconds=5, wait_first=False, raise_exceptions=True)
 async def append_new_events():
-    """Append new events from the queue to the miner's live event stream."""
-    for log, queue in new_event_queue.items():
-        events: List[MqttEvent] = []
-        while not queue.empty():
-            events.append(queue.get())
-        if events:
-            events.sort(key=lambda e: e.timestamp)
-            if log not in miners:
-                ws_update_queue = Queue()
-                logging.info(f'Creating new miner for "{log}" with {len(events)} initial events.')
-                miners[log] = Miner(log, ws_update_queue, events)
-                ws_updates_queue[log] = ws_update_queue
-            else:
-                logging.info(f'Appending {len(events)} new events for "{log}".')
-                miners[log].append_events_to_stream(events)
+    """Append new events from the queue of each scheduled log to the miner's live event stream.
+    Events of logs that are still being loaded from the DB are held back, to keep them after the history."""
+    while True:
+        log = await ingest_queue.get()
+        ingest_scheduled.discard(log)
+        if listing_logs or hydration_status.get(log) == 'hydrating':
+            continue
+        buffer, spill = event_buffers[log], spills.get(log)
+        try:
+            if spill is not None and len(spill):
+                # Drain spilled events in chunks, yielding to the event loop in between
+                chunk = get_log_setting(log, 'INGEST_HIGH_WATERMARK', 100000) - get_log_setting(log, 'INGEST_LOW_WATERMARK', 50000)
+                buffer.extend_rows(spill.read(max(1, chunk)))
+                if len(spill):
+                    schedule_ingest(log)
+            batch = buffer.take()
+            if batch is not None:
+                event_writer.get_watermark(log).ingested(len(batch))
+                append_batch_to_miner(log, batch)
+        except Exception as e:
+            logging.error(f'Appending events for "{log}" failed: {e}')
+        if log in ingest_scheduled:
+            await asyncio.sleep(0)
+
+
+async def run_model_updates(log: str):
+    """Update the model of a log whenever its events changed. An update waits until no new events arrived for
+    UPDATE_DEBOUNCE seconds, but at most UPDATE_MAX_DELAY seconds after the first new event, and updates are at
+    least UPDATE_MIN_INTERVAL seconds apart. Discovery runs in the discovery executor, so logs update concurrently."""
+    loop = asyncio.get_running_loop()
+    requested = update_requested[log]
+    debounce = get_log_setting(log, 'UPDATE_DEBOUNCE', 0.5)
+    max_delay = get_log_setting(log, 'UPDATE_MAX_DELAY', 5.0)
+    min_interval = get_log_setting(log, 'UPDATE_MIN_INTERVAL', 1.0)
+    last_update = float('-inf')
+    while True:
+        await requested.wait()
+        first_request = loop.time()
+        while True:
+            requested.clear()
+            timeout = min(debounce, first_request + max_delay - loop.time())
+            if timeout <= 0:
+                break
+            try:
+                await asyncio.wait_for(requested.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                break
+        await asyncio.sleep(last_update + min_interval - loop.time())
+        requested.clear()
+
+        last_update = loop.time()
+        try:
+            await update_miner(log, miners[log])
+            await broadcast_queued_updates(log)
+            if miners[log].xes_conformance_pending is not None and log not in xes_conformance_tasks:
+                xes_conformance_tasks[log] = asyncio.create_task(track_xes_conformance(log, miners[log]))
+        except Exception as e:
+            logging.error(f'Updating model for "{log}" failed: {e}')
+
+
+async def update_miner(log: str, miner: Miner):
+    """Discover the model of a miner's current DFG off the event loop, and apply it to the miner."""
+    with tracing.span('dfg_snapshot', log):
+        fingerprint, dfg = miner.dfg_snapshot()
+    DFG_ACTIVITIES.set(len(dfg[1]), log)
+    DFG_EDGES.set(len(dfg[0]), log)
+    if fingerprint == miner.model_fingerprint:
+        return
+
+    petri_net = miner.cached_petri_net(fingerprint)
+    if petri_net is None:
+        logging.debug(f'Updating model for "{log}" miner.')
+        try:
+            petri_net = await discover_within_budget(log, miner, dfg)
+        except Exception as e:
+            logging.error(f'Model discovery for "{log}" failed: {e}')
+            return
+    with tracing.span('apply_model', log):
+        miner.apply_petri_net(fingerprint, petri_net)
+    model = miner.current_model()
+    if os.environ['SAVE_PICTURES'] == 'True' and model is not None:
+        renderer.request(log, model)
+
+
+async def discover_within_budget(log: str, miner: Miner, dfg: discovery.Dfg) -> Tuple[PetriNet, Marking, Marking]:
+    """Discover the model of a DFG with the miner's engine and filter. If discovery takes longer than
+    DISCOVERY_TIME_BUDGET seconds, it is retried on a DFG with only DISCOVERY_DEGRADE_FACTOR as many edges, up to
+    DISCOVERY_MAX_DEGRADE times, the last time without a budget. Discovery starts at the level the previous one
+    ended at, or one level lower if that took less than half the budget. A timed out discovery can't be interrupted,
+    so it finishes in the background and its model is discarded."""
+    loop = asyncio.get_running_loop()
+    budget = get_log_setting(log, 'DISCOVERY_TIME_BUDGET', 0.0)
+    max_level = get_log_setting(log, 'DISCOVERY_MAX_DEGRADE', 3)
+    factor = get_log_setting(log, 'DISCOVERY_DEGRADE_FACTOR', 0.5)
+    level = 0
+    if budget > 0:
+        level = min(max_level, max(0, miner.discovery_level - (miner.discovery_seconds < budget / 2)))
+    edges = len(miner.dfg_filter.apply(*dfg)[0])
+    while True:
+        dfg_filter = miner.dfg_filter.degraded(edges, level, factor) if level else miner.dfg_filter
+        start = time.perf_counter()
+        future = loop.run_in_executor(discovery_executor, discovery.discover_petri_net, *dfg, miner.discovery_engine, dfg_filter)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())  # Don't warn about abandoned attempts
+        try:
+            with tracing.span('discovery', log, activities=len(dfg[1]), edges=len(dfg[0]), level=level):
+                petri_net = await asyncio.wait_for(asyncio.shield(future), budget if 0 < budget and level < max_level else None)
+        except asyncio.TimeoutError:
+            level += 1
+            DISCOVERY_DEGRADED.inc(log)
+            logging.warning(f'Discovery for "{log}" exceeded its time budget of {budget}s, retrying with '
+                            f'{miner.dfg_filter.degraded(edges, level, factor).max_edges} of {edges} edges.')
+            continue
+        miner.discovery_level, miner.discovery_seconds = level, time.perf_counter() - start
+        DISCOVERY_SECONDS.observe(miner.discovery_seconds, log)
+        DISCOVERY_LEVEL.set(level, log)
+        return petri_net
+
+
+async def track_xes_conformance(log: str, miner: Miner):
+    """Check the models of a miner against its reference XES in the background, skipping models that were replaced
+    while the previous one was checked. CONFORMANCE_SAMPLE_RATE and CONFORMANCE_TIME_BUDGET bound each check."""
+    loop = asyncio.get_running_loop()
+    sample_rate = get_log_setting(log, 'CONFORMANCE_SAMPLE_RATE', 1.0)
+    time_budget = get_log_setting(log, 'CONFORMANCE_TIME_BUDGET', 0.0)
+    try:
+        while miner.xes_conformance_pending is not None:
+            (recorded, petri_net), miner.xes_conformance_pending = miner.xes_conformance_pending, None
+            try:
+                fitness, coverage = await loop.run_in_executor(discovery_executor, conformance.replay_variants, *petri_net,
+                                                               miner.xes_file, sample_rate, time_budget)
+                await loop.run_in_executor(None, miner.write_xes_conformance, recorded, fitness, coverage)
+                logging.info(f'Fitness of "{log}" model on reference XES: {fitness} ({coverage:.0%} of traces replayed).')
+            except Exception as e:
+                logging.error(f'Conformance checking of "{log}" model on reference XES failed: {e}')
+    finally:
+        del xes_conformance_tasks[log]
 
 
-@app.on_event('startup')
-@repeat_every(seconds=10, wait_first=False, raise_exceptions=True)
-async def run_miner_updates():
-    """Periodically update the model derived from the live event stream of each miner."""
-    for log, miner in miners.items():
-        logging.debug(f'Updating model for "{log}" miner.')
-        miner.update()
+@app.on_event('shutdown')
+def shutdown_discovery_executor():
+    discovery_executor.shutdown(wait=True)
+    renderer.close()
 
 
 # WebSockets Part
 
 
-@app.on_event('startup')
-@repeat_every(seconds=1, wait_first=False, raise_exceptions=True)
-async def broadcast_queued_updates():
-    for log, queue in ws_updates_queue.items():
-        updates: List[PetriNetState] = []
-        while not queue.empty():
-            updates.append(queue.get(block=True, timeout=1))
-        if updates:
-            try:
-                for update in updates:
-                    update_text = update.to_json()
-                    recipients = await ws_manager.broadcast(update_text, log)
-                    logging.info(f'Broadcasted update to {recipients} "{log}" clients: {update_text}')
-            except Exception as e:
-                logging.error(e)
+async def broadcast_queued_updates(log: str):
+    """Broadcast the updates a miner produced to the WebSocket clients of its log."""
+    queue = ws_updates_queue[log]
+    updates: List[Update] = []
+    while not queue.empty():
+        updates.append(queue.get())
+    if queue.merged:
+        MERGED_UPDATES.inc(log, amount=queue.merged)
+        queue.merged = 0
+    if updates:
+        try:
+            for update in updates:
+                MODEL_UPDATES.inc(log)
+                UPDATE_ELEMENTS.observe(len(update.new_places) + len(update.new_transitions) + len(update.new_edges) +
+                                        len(update.removed_places) + len(update.removed_transitions) +
+                                        len(update.removed_edges), log)
+                with tracing.span('serialize', log):
+                    message = Message(update.to_json())
+                with tracing.span('broadcast', log):
+                    recipients = ws_manager.broadcast(message, log)
+                logging.info(f'Broadcasted update to {recipients} "{log}" clients: {message.text}')
+        except Exception as e:
+            logging.error(e)
 
 
 @app.websocket('/ws/{log}')
@@ -158,15 +744,13 @@ async def ws(websocket: WebSocket, log: str):
     await ws_manager.connect(websocket, log)
     try:
         logging.info(f'WS connection opened with client from: {websocket.client.host}:{websocket.client.port}')
-        if log not in miners.keys():
+        if log not in miners.keys() and (relay is None or not await relay.has_log(log)):
             logging.warning(f'WS connection opened for log "{log}", but no miner exists for this log.')
             raise WebSocketDisconnect(code=1003)  # https://datatracker.ietf.org/doc/html/rfc6455#section-7.4.1
 
-        # Send latest complete model and ongoing instances
-        update = miners[log].latest_complete_update()
-        update_text = update.to_json()
-        await websocket.send_text(update_text)
-        logging.info(f'Sent latest state to newly connected WS client from {websocket.client.host}:{websocket.client.port}: {update_text}')
+        # The connection manager sends the latest complete model first
+        if relay is not None:
+            relay.subscribe(log)
 
         while True:  # We need to await something, otherwise the connection will terminate after executing this method
             msg = await websocket.receive_text()
@@ -174,8 +758,12 @@ async def ws(websocket: WebSocket, log: str):
                 logging.info(f'Received stop command, closing WS connection')
                 raise WebSocketDisconnect(code=1000)
     except WebSocketDisconnect as e:
-        ws_manager.disconnect(websocket)
         logging.info(f'WS connection closed with client from: {websocket.client.host}:{websocket.client.port}. Status code: {e.code}')
+    except HTTPException as e:  # The relay couldn't reach the miner process
+        logging.warning(f'Closing WS connection for log "{log}": {e.detail}')
+        await websocket.close(code=1013)  # Try again later
+    finally:
+        ws_manager.disconnect(websocket)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from bisect import bisect_left
+import math
+
+LabelValues = Tuple[str, ...]
+
+# All metrics, in the order they are rendered
+registry: List['Metric'] = []
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Metric:
+    """A metric in the Prometheus text exposition format. Updating a metric only touches a dict entry,
+    so metrics can be updated on every event or message."""
+    type = ''
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def label_text(self, values: LabelValues, extra: str = '') -> str:
+        pairs = [f'{k}="{escape(v)}"' for k, v in zip(self.labels, values)] + ([extra] if extra else [])
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}'] + self.samples())
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{self.label_text(k)} {format_value(v)}' for k, v in list(self.values.items())]
+
+
+class Gauge(Metric):
+    """A gauge that is either set directly, or collected when rendered by a function returning values by labels."""
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        super().__init__(name, description, labels)
+        self.values: Dict[LabelValues, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def remove(self, *labels: str):
+        self.values.pop(labels, None)
+
+    def samples(self) -> List[str]:
+        values = self.collect() if self.collect is not None else self.values
+        return [f'{self.name}{self.label_text(k)} {format_value(v)}' for k, v in list(values.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[LabelValues, List[float]] = {}  # Per labels: count per bucket (and +Inf), then the sum
+
+    def observe(self, value: float, *labels: str):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, counts in list(self.values.items()):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self.label_text(labels, f"le={format_bound(bound)}")} {cumulative}')
+            lines.append(f'{self.name}_sum{self.label_text(labels)} {format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{self.label_text(labels)} {cumulative}')
+        return lines
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_bound(bound: float) -> str:
+    return '"+Inf"' if bound == math.inf else f'"{bound}"'
+
+
+def render() -> str:
+    """Render all metrics in the Prometheus text exposition format."""
+    return '\n'.join(m.render() for m in registry) + '\n'
@@ -1,34 +1,26 @@
-from petri_net_state import PetriNetState, Update, StatePlace, StateTransition, StateEdge
-from typing import Optional, List, Tuple, Set, Union
-from multiprocessing import Queue
+from petri_net_state import PetriNetState, Update, UpdateQueue, StatePlace, StateTransition, StateEdge
+from typing import Optional, Dict, List, Tuple, Set, Union
+from collections import OrderedDict
+from log_config import get_log_setting
+from event_buffer import EventBatch
 from mqtt_event import MqttEvent
-import pandas as pd
+import event_buffer
+import discovery
+import tracing
+import ingest
 import logging
-import arrow
+import json
 import uuid
 import os
 
-from pm4py import format_dataframe
-from pm4py.objects.conversion.log import converter
 from pm4py.objects.petri_net.obj import PetriNet, Marking
-from pm4py.objects.log.importer.xes import importer as xes_importer
-from pm4py.streaming.stream.live_event_stream import LiveEventStream
-from pm4py.streaming.algo.discovery.dfg import algorithm as dfg_discovery
-from pm4py.algo.conformance.tokenreplay import algorithm as token_replay
-from pm4py.algo.discovery.inductive import algorithm as inductive_miner
 from pm4py.objects.petri_net.exporter import exporter as pnml_exporter
-from pm4py.visualization.petri_net import visualizer as pn_visualizer
 
+MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', 8))
+CONFORMANCE_CACHE_SIZE = int(os.environ.get('CONFORMANCE_CACHE_SIZE', 10000))
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '../snapshots')
 
-def save_petri_net_image(net, initial, final, name: str):
-    """Visualize a Petri net using graphviz (opens in local image viewer)."""
-    directory = f'../pn_images/{name}'
-    os.makedirs(directory, exist_ok=True)
-    file = f'{directory}/{arrow.utcnow().int_timestamp}.svg'
-    logging.info(f'Saving Petri net image to file: {file}')
-    parameters = {pn_visualizer.Variants.WO_DECORATION.value.Parameters.FORMAT: "svg"}
-    gviz = pn_visualizer.apply(net, initial, final, parameters=parameters)
-    pn_visualizer.save(gviz, file)
+DfgSnapshot = Tuple[dict, dict, dict, dict]
 
 
 def export_to_plnm(net, initial, final, file: str):
@@ -37,151 +29,312 @@ def export_to_plnm(net, initial, final, file: str):
     pnml_exporter.apply(net, initial, file, final_marking=final)
 
 
-def get_pm4py_stream(events: List[MqttEvent]):
-    """Convert a list of event to a Pandas DataFrame compatible with pm4py."""
-    if not events:
-        return None
-
-    log = pd.DataFrame.from_records([e.to_min_dict() for e in events])
-    log = log.sort_values(by='timestamp')
-    log = format_dataframe(log, case_id='process', activity_key='activity', timestamp_key='timestamp')
-    return converter.apply(log, variant=converter.Variants.TO_EVENT_STREAM)
+def dfg_fingerprint(dfg: dict, activities: dict, start_act: dict, end_act: dict) -> int:
+    """Compute a content fingerprint of a DFG, its activities and its start and end activities."""
+    return hash((frozenset(dfg.items()), frozenset(activities.items()),
+                 frozenset(start_act.items()), frozenset(end_act.items())))
 
 
 class Miner:
-    def __init__(self, log: str, update_queue: Queue, events: List[MqttEvent] = None):
+    def __init__(self, log: str, update_queue: UpdateQueue, events: Optional[List[MqttEvent]] = None):
         """Initialize the miner with potentially existing events."""
         self.log_name = log
         self.update_queue = update_queue
-        self.initial_events: List[MqttEvent] = events if events is not None else []
         self.petri_net_state: Optional[PetriNetState] = None
-
-        # Register live event stream and starting DFG (Directly Follows Graph) discovery
-        self.live_event_stream = LiveEventStream()
+        self.model_version = 0  # Incremented whenever the Petri net state changes
+        self.model_hash: Optional[int] = None  # Content hash of the Petri net state
+
+        # IDs of the elements of the current Petri net state, by place or transition name and by (source, target) for
+        # edges. Elements get an ID when they first appear and keep it while they are part of the model.
+        self.place_ids: Dict[str, str] = {}
+        self.transition_ids: Dict[str, str] = {}
+        self.edge_ids: Dict[Tuple[str, str], str] = {}
+
+        # Discovered models by DFG fingerprint, so unchanged DFGs are never rediscovered
+        self.model_cache: OrderedDict[int, Tuple[PetriNet, Marking, Marking]] = OrderedDict()
+        self.model_fingerprint: Optional[int] = None
+
+        # Discovery engine and DFG noise filter of this log, and how strongly the DFG had to be filtered further for
+        # the last discovery to finish within its time budget (0 = not degraded)
+        self.discovery_engine = get_log_setting(log, 'DISCOVERY_ENGINE', 'imd')
+        if self.discovery_engine not in discovery.ENGINES:
+            logging.error(f'Unknown discovery engine "{self.discovery_engine}" for "{log}", using IMd.')
+            self.discovery_engine = 'imd'
+        self.dfg_filter = discovery.DfgFilter(min_activity_count=get_log_setting(log, 'MIN_ACTIVITY_COUNT', 0.0),
+                                              max_activities=get_log_setting(log, 'MAX_ACTIVITIES', 0),
+                                              min_edge_count=get_log_setting(log, 'MIN_EDGE_COUNT', 0.0),
+                                              max_edges=get_log_setting(log, 'MAX_EDGES', 0))
+        self.discovery_level = 0
+        self.discovery_seconds = 0.0
+
+        # Token replay results, referring to elements by ID, by model version and trace, so each trace variant is
+        # replayed once per model
+        self.replay_cache: OrderedDict[Tuple[int, Tuple[str, ...]], dict] = OrderedDict()
+
+        # Start streaming DFG (Directly Follows Graph) discovery with the configured ingest engine
         self.recorded = 0
-        self.streaming_dfg = dfg_discovery.apply()
-        self.live_event_stream.register(self.streaming_dfg)
-        self.live_event_stream.start()
+        self.streaming_dfg = ingest.create_ingest_engine(get_log_setting(log, 'INGEST_ENGINE', 'native'),
+                                                         max_open_cases=get_log_setting(log, 'MAX_OPEN_CASES', 0),
+                                                         case_ttl=get_log_setting(log, 'CASE_TTL', 0.0),
+                                                         window=get_log_setting(log, 'MODEL_WINDOW', 'all'),
+                                                         window_size=get_log_setting(log, 'WINDOW_SIZE', 0.0),
+                                                         half_life=get_log_setting(log, 'DECAY_HALF_LIFE', 3600.0))
+        self.last_dfg_snapshot: Optional[Tuple[int, int, DfgSnapshot]] = None
+
+        # Watermark of the recorded events, used to restore the DFG from a snapshot and only replay newer events
+        self.last_rowid = 0
+        self.snapshot_recorded = 0
+        self.save_snapshots = os.environ.get('SAVE_SNAPSHOTS', 'False') == 'True'
+        if self.save_snapshots:
+            self.load_snapshot()
 
         # Additional feature for performing conformance checking on the model using an existing XES file
         self.do_conformance_check = os.environ['CONFORMANCE_CHECK'] == 'True'
         if self.do_conformance_check:
             os.makedirs('../xes-files', exist_ok=True)
             os.makedirs('../conf-check', exist_ok=True)
-            self.xes = xes_importer.apply(f'../xes-files/{self.log_name}.xes', variant=xes_importer.Variants.ITERPARSE, parameters={xes_importer.Variants.ITERPARSE.value.Parameters.TIMESTAMP_SORT: True})
+            # Parsed into its cache file (see reference_log) by the first conformance check, off the event loop
+            self.xes_file = f'../xes-files/{self.log_name}.xes'
             self.xes_conf_file = open(f'../conf-check/{self.log_name}.csv', 'w')
-            self.xes_conf_file.write('Events,Fitness\n')
+            self.xes_conf_file.write('Events,Fitness,Coverage\n')
+        # Latest model that wasn't checked against the XES yet, with the number of events it was discovered from
+        self.xes_conformance_pending: Optional[Tuple[int, Tuple[PetriNet, Marking, Marking]]] = None
 
-        # Add initial events to live event stream
-        self.append_events_to_stream(self.initial_events)
+        # Add initial events to live event stream, without keeping a reference to them
+        self.append_events_to_stream(events)
 
-    def append_events_to_stream(self, events: List[MqttEvent]):
+    def append_events_to_stream(self, events: Optional[List[MqttEvent]]):
         """Append new events to the live event stream"""
-        if events:
-            logging.debug(f'Appending {len(events)} new events to stream of "{self.log_name}" miner.')
-            event_stream = get_pm4py_stream(events)
-            for event in event_stream:
-                self.live_event_stream.append(event)
-                self.recorded += 1
+        batch = event_buffer.batch_from_events(events or [])
+        if batch is not None:
+            self.append_batch(batch)
+
+    def append_batch(self, batch: EventBatch):
+        """Append a columnar batch of new events (see event_buffer) to the live event stream."""
+        if len(batch):
+            logging.debug(f'Appending {len(batch)} new events to stream of "{self.log_name}" miner.')
+            evicted = self.streaming_dfg.evicted
+            with tracing.span('append_events', self.log_name, events=len(batch)):
+                self.streaming_dfg.append_batch(batch)
+            if self.streaming_dfg.evicted > evicted:
+                logging.info(f'Evicted {self.streaming_dfg.evicted - evicted} idle cases of "{self.log_name}" miner, '
+                             f'{self.streaming_dfg.count_open_cases()} cases remain open.')
+            self.recorded += len(batch)
+            self.last_rowid = max(self.last_rowid, batch.last_rowid)
+
+    def stats(self) -> dict:
+        """Get the number of recorded events, open cases and cases evicted from the open case tracking,
+        and the discovery engine and degradation level of the current model."""
+        return {'recorded': self.recorded, 'open_cases': self.streaming_dfg.count_open_cases(),
+                'evicted_cases': self.streaming_dfg.evicted, 'discovery_engine': self.discovery_engine,
+                'discovery_level': self.discovery_level}
+
+    def snapshot_file(self) -> str:
+        return f'{SNAPSHOT_DIR}/{self.log_name}.json'
+
+    def save_snapshot(self, recorded: int, last_rowid: int) -> bool:
+        """Checkpoint the streaming DFG state to the snapshot file of this log, given the number of recorded events
+        and the rowid up to which the event store contains exactly these events. Skipped if nothing was recorded since
+        the last snapshot, or if the stream processed a different number of events."""
+        if recorded == self.snapshot_recorded:
+            return False
+
+        processed, state = self.streaming_dfg.export_state()
+        if processed != recorded:
+            logging.debug(f'Stream of "{self.log_name}" miner is still processing events, skipping snapshot.')
+            return False
+
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        file = self.snapshot_file()
+        with open(f'{file}.tmp', 'w') as f:
+            json.dump({'rowid': last_rowid, 'recorded': recorded, 'state': state}, f)
+        os.replace(f'{file}.tmp', file)
+        self.snapshot_recorded = recorded
+        logging.info(f'Saved snapshot of "{self.log_name}" miner with {recorded} events up to rowid {last_rowid}.')
+        return True
+
+    def load_snapshot(self) -> bool:
+        """Restore the streaming DFG state and the watermark of its events from the snapshot file of this log."""
+        file = self.snapshot_file()
+        if not os.path.exists(file):
+            return False
+        try:
+            with open(file) as f:
+                snapshot = json.load(f)
+            self.streaming_dfg.import_state(snapshot['state'])
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f'Couldn\'t load snapshot {file}: {e}')
+            return False
+
+        self.recorded = self.snapshot_recorded = snapshot['recorded']
+        self.last_rowid = snapshot['rowid']
+        logging.info(f'Restored "{self.log_name}" miner from snapshot with {self.recorded} events up to rowid {self.last_rowid}.')
+        return True
 
     def get_petri_net(self) -> Tuple[PetriNet, Marking, Marking]:
         """Get the current Petri net from the event stream."""
-        dfg, activities, start_act, end_act = self.streaming_dfg.get()
-        return inductive_miner.apply_dfg(dfg, start_act, end_act, activities, variant=inductive_miner.Variants.IMd)
+        return self.discover()[1]
+
+    def discover(self) -> Tuple[int, Tuple[PetriNet, Marking, Marking]]:
+        """Get the fingerprint of the current DFG and its Petri net, only running discovery on a cache miss."""
+        fingerprint, dfg = self.dfg_snapshot()
+        petri_net = self.cached_petri_net(fingerprint)
+        if petri_net is None:
+            petri_net = discovery.discover_petri_net(*dfg, self.discovery_engine, self.dfg_filter)
+            self.cache_petri_net(fingerprint, petri_net)
+        return fingerprint, petri_net
+
+    def dfg_snapshot(self) -> Tuple[int, DfgSnapshot]:
+        """Get the fingerprint and a copy of the current DFG, activities, start and end activities.
+        If the ingest engine tracks a version, the previous snapshot is reused while the version is unchanged."""
+        version = self.streaming_dfg.version
+        if version is not None and self.last_dfg_snapshot and self.last_dfg_snapshot[0] == version:
+            return self.last_dfg_snapshot[1], self.last_dfg_snapshot[2]
 
-    def conformance_check_xes(self, net, initial, final):
-        replay = token_replay.apply(self.xes, net, initial, final)
-        avg_fitness = sum([r['trace_fitness'] for r in replay]) / len(replay)
-        self.xes_conf_file.write(f'{self.recorded};{avg_fitness}\n')
+        dfg, activities, start_act, end_act = self.streaming_dfg.get()
+        fingerprint = dfg_fingerprint(dfg, activities, start_act, end_act)
+        if version is not None:
+            self.last_dfg_snapshot = (version, fingerprint, (dfg, activities, start_act, end_act))
+        return fingerprint, (dfg, activities, start_act, end_act)
+
+    def cached_petri_net(self, fingerprint: int) -> Optional[Tuple[PetriNet, Marking, Marking]]:
+        """Get a previously discovered Petri net for a DFG fingerprint, if still cached."""
+        petri_net = self.model_cache.get(fingerprint)
+        if petri_net is not None:
+            self.model_cache.move_to_end(fingerprint)
+        return petri_net
+
+    def cache_petri_net(self, fingerprint: int, petri_net: Tuple[PetriNet, Marking, Marking]):
+        """Store a discovered Petri net, evicting the least recently used one if the cache is full."""
+        self.model_cache[fingerprint] = petri_net
+        self.model_cache.move_to_end(fingerprint)
+        if len(self.model_cache) > MODEL_CACHE_SIZE:
+            self.model_cache.popitem(last=False)
+
+    def write_xes_conformance(self, recorded: int, fitness: float, coverage: float):
+        self.xes_conf_file.write(f'{recorded};{fitness};{coverage}\n')
         self.xes_conf_file.flush()
 
-    def conformance_check(self, events: List[str]):
-        """Perform a performance check on the current Petri net with the specified trace."""
-        net, initial, final = self.get_petri_net()
-        df = pd.DataFrame.from_records([{'process': 'p1', 'activity': e, 'timestamp': i} for i, e in enumerate(events)])
-        df = format_dataframe(df, case_id='process', activity_key='activity', timestamp_key='timestamp')
-        log = converter.apply(df, variant=converter.Variants.TO_EVENT_LOG)
-        replayed_traces = token_replay.apply(log, net, initial, final)
-        return replayed_traces
-
-    def name_to_id(self, name: id) -> str:
+    def current_petri_net(self) -> Optional[Tuple[PetriNet, Marking, Marking]]:
+        """Get the Petri net of the current model, or None if no model was discovered yet."""
+        if self.model_fingerprint is None:
+            return None
+        return self.model_cache.get(self.model_fingerprint)
+
+    def current_model(self) -> Optional[Tuple[int, int, Tuple[PetriNet, Marking, Marking]]]:
+        """Get the content hash, version and Petri net of the current model, or None if no model was discovered yet."""
+        petri_net = self.current_petri_net()
+        if petri_net is None or self.model_hash is None:
+            return None
+        return self.model_hash, self.model_version, petri_net
+
+    def cached_replay(self, model_version: int, trace: Tuple[str, ...]) -> Optional[dict]:
+        result = self.replay_cache.get((model_version, trace))
+        if result is not None:
+            self.replay_cache.move_to_end((model_version, trace))
+        return result
+
+    def cache_replay(self, model_version: int, trace: Tuple[str, ...], result: dict):
+        """Store the replay result of a trace, evicting the least recently used one if the cache is full."""
+        self.replay_cache[(model_version, trace)] = result
+        if len(self.replay_cache) > CONFORMANCE_CACHE_SIZE:
+            self.replay_cache.popitem(last=False)
+
+    def element_ids(self) -> Dict[str, str]:
+        """Get the IDs of the places and transitions of the current model by name, like name_to_id."""
+        return {**self.transition_ids, **self.place_ids}
+
+    @staticmethod
+    def replay_result_with_ids(result: dict, ids: Dict[str, str]) -> dict:
+        """Refer to the transitions and places of a replay result (see conformance.replay_traces) by their IDs,
+        given by name (see element_ids), of the model the traces were replayed on."""
+        def t_names(tr: List[Tuple[Optional[str], str]]) -> List[str]:
+            return [ids.get(label, label) if label else name for label, name in tr]
+
+        return {'trace_is_fit': result['trace_is_fit'], 'trace_fitness': result['trace_fitness'],
+                'activated_transitions': t_names(result['activated_transitions']),
+                'reached_marking': [ids.get(p, p) for p in result['reached_marking']],
+                'enabled_transitions_in_marking': t_names(result['enabled_transitions_in_marking']),
+                'transitions_with_problems': t_names(result['transitions_with_problems']),
+                'missing_tokens': result['missing_tokens'], 'consumed_tokens': result['consumed_tokens'],
+                'remaining_tokens': result['remaining_tokens'], 'produced_tokens': result['produced_tokens']}
+
+    def name_to_id(self, name: str) -> str:
         """Finds a place or transition with the specified name in the current Petri net, and returns its ID.
            If no match can be found, the name is returned."""
-        for p in self.petri_net_state.places:
-            if p.name == name:
-                return p.id
-
-        for t in self.petri_net_state.transitions:
-            if t.name == name:
-                return t.id
-
-        return name
+        return self.place_ids.get(name) or self.transition_ids.get(name, name)
 
     def update(self):
         """Update the Petri net and broadcast any changes to the WebSocket clients"""
-        net, initial, final = self.get_petri_net()
-
-        if os.environ['SAVE_PICTURES'] == 'True':
-            save_petri_net_image(net, initial, final, name=self.log_name)
-
+        fingerprint, petri_net = self.discover()
+        self.apply_petri_net(fingerprint, petri_net)
+
+    def apply_petri_net(self, fingerprint: int, petri_net: Tuple[PetriNet, Marking, Marking]):
+        """Make a discovered Petri net the current model and queue the changes, unless it is the current model already."""
+        self.cache_petri_net(fingerprint, petri_net)
+        if fingerprint == self.model_fingerprint:
+            logging.debug(f'DFG of "{self.log_name}" miner is unchanged, skipping model update.')
+            return
+        self.model_fingerprint = fingerprint
+        net, initial, final = petri_net
         self.create_update(self.petri_net_state, (net, initial, final))
 
     def create_update(self, prev_state: Optional[PetriNetState], new_petri_net: Tuple[PetriNet, Marking, Marking]):
         """Compare the previous Petri net and instances to the new one, and send updates to the update queue."""
         n_net, n_init, n_final = new_petri_net
 
-        new_state = get_petri_net_state(self.log_name, n_net)
+        with tracing.span('convert_state', self.log_name):
+            new_state = get_petri_net_state(self.log_name, n_net, self.place_ids, self.transition_ids, self.edge_ids)
 
         if not prev_state:
             new_update_state = Update(new_state.id, new_state.places, set(), new_state.transitions, set(), new_state.edges, set())
             self.update_queue.put(new_update_state)
-            self.petri_net_state = new_state
+            self.update_internal_state(new_update_state, new_state)
             return
 
-        update_state = get_update(prev_state, new_state)
+        with tracing.span('diff', self.log_name):
+            update_state = get_update(prev_state, new_state)
 
         if update_state.is_not_empty():
             self.update_queue.put(update_state)
-            self.update_internal_state(prev_state, new_state)
+            with tracing.span('register_ids', self.log_name):
+                self.update_internal_state(update_state, new_state)
 
             if self.do_conformance_check:
-                self.conformance_check_xes(n_net, n_init, n_final)
-
-    def update_internal_state(self, old: PetriNetState, new: PetriNetState) -> None:
-        """Update the internal state, keeping original ID's of transitions and edges intact."""
-        self.petri_net_state.places = new.places
-
-        for new_p in new.places:
-            matching = next((p for p in old.places if p == new_p), None)
-            if matching:
-                new_p.id = matching.id
-        self.petri_net_state.places = new.places
-
-        for new_t in new.transitions:
-            matching = next((t for t in old.transitions if t == new_t), None)
-            if matching:
-                new_t.id = matching.id
-        self.petri_net_state.transitions = new.transitions
-
-        for new_e in new.edges:
-            matching = next((e for e in old.edges if e == new_e), None)
-            if matching:
-                new_e.id = matching.id
-        self.petri_net_state.edges = new.edges
+                self.xes_conformance_pending = (self.recorded, new_petri_net)  # Checked in the background
+
+    def update_internal_state(self, update: Update, new: PetriNetState) -> None:
+        """Make the new state the current one, and register the IDs of the elements that were added or removed.
+        The new state already uses the registered IDs of the elements it shares with the previous state."""
+        for p in update.removed_places:
+            del self.place_ids[p.name]
+        for t in update.removed_transitions:
+            del self.transition_ids[t.name]
+        for e in update.removed_edges:
+            del self.edge_ids[(e.source, e.target)]
+        self.place_ids.update((p.name, p.id) for p in update.new_places)
+        self.transition_ids.update((t.name, t.id) for t in update.new_transitions)
+        self.edge_ids.update(((e.source, e.target), e.id) for e in update.new_edges)
+        self.petri_net_state = new
+        self.model_version += 1
+        self.model_hash = hash((frozenset(new.places), frozenset(new.transitions), frozenset(new.edges)))
 
     def latest_complete_update(self) -> Update:
         """Get an update that contains the entire Petri net model and ongoing instances.
-        This is used to send the latest state for newly connected WebSocket clients."""
-        return Update(self.log_name, self.petri_net_state.places, set(), self.petri_net_state.transitions, set(),
-                      self.petri_net_state.edges, set())
+        This is used to send the latest state for newly connected WebSocket clients.
+        Before the first model is discovered, the update is empty."""
+        state = self.petri_net_state or PetriNetState(self.log_name, set(), set(), set())
+        return Update(self.log_name, state.places, set(), state.transitions, set(), state.edges, set())
 
 
 # State helper methods
 
 
-def get_petri_net_state(name: str, net: PetriNet) -> PetriNetState:
-    """Convert a Petri net to a simple state object."""
-    return PetriNetState(name, places_to_set(net.places), transitions_to_set(net.transitions), arcs_to_set(net.arcs))
+def get_petri_net_state(name: str, net: PetriNet, place_ids: Dict[str, str], transition_ids: Dict[str, str],
+                        edge_ids: Dict[Tuple[str, str], str]) -> PetriNetState:
+    """Convert a Petri net to a simple state object, reusing the IDs of registered elements."""
+    return PetriNetState(name, places_to_set(net.places, place_ids), transitions_to_set(net.transitions, transition_ids),
+                         arcs_to_set(net.arcs, edge_ids))
 
 
 def get_update(old: PetriNetState, new: PetriNetState) -> Update:
@@ -195,23 +348,24 @@ def get_update(old: PetriNetState, new: PetriNetState) -> Update:
     return Update(new.id, p_new, p_rem, t_new, t_rem, e_new, e_rem)
 
 
-def places_to_set(places: Set[PetriNet.Place]) -> Set[StatePlace]:
+def places_to_set(places: Set[PetriNet.Place], ids: Dict[str, str]) -> Set[StatePlace]:
     """Convert a set of places of a Petri net to a simple set."""
     names: Set[StatePlace] = set()
     for p in places:
-        names.add(StatePlace(str(uuid.uuid4()), p.name))
+        names.add(StatePlace(ids.get(p.name) or str(uuid.uuid4()), p.name))
     return names
 
 
-def transitions_to_set(transitions: Set[PetriNet.Transition]) -> Set[StateTransition]:
+def transitions_to_set(transitions: Set[PetriNet.Transition], ids: Dict[str, str]) -> Set[StateTransition]:
     """Convert a set of transitions of a Petri net to a simple set."""
     names: Set[StateTransition] = set()
     for t in transitions:
-        names.add(StateTransition(str(uuid.uuid4()), t.label if t.label else t.name))
+        name = t.label if t.label else t.name
+        names.add(StateTransition(ids.get(name) or str(uuid.uuid4()), name))
     return names
 
 
-def arcs_to_set(arcs: Set[PetriNet.Arc]) -> Set[StateEdge]:
+def arcs_to_set(arcs: Set[PetriNet.Arc], ids: Dict[Tuple[str, str], str]) -> Set[StateEdge]:
     """Convert a set of transitions of a Petri net to a simple set."""
     names: Set[StateEdge] = set()
     for a in arcs:
@@ -226,5 +380,5 @@ def arcs_to_set(arcs: Set[PetriNet.Arc]) -> Set[StateEdge]:
         elif type(a.target) is PetriNet.Transition:
             target = a.target.label if a.target.label else a.target.name
 
-        names.add(StateEdge(str(uuid.uuid4()), source, target))
+        names.add(StateEdge(ids.get((source, target)) or str(uuid.uuid4()), source, target))
     return names
@@ -1,5 +1,21 @@
 import jsonpickle
-from typing import Set
+import json
+from types import ModuleType
+from queue import Empty
+from typing import Dict, Optional, Set, Tuple
+
+orjson: Optional[ModuleType]
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library encoder
+    orjson = None
+
+
+def encode_json(obj) -> str:
+    """Encode plain data (dicts, lists, strings) as JSON, using orjson if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
 
 
 class StatePlace(object):
@@ -7,6 +23,9 @@ class StatePlace(object):
         self.id = id
         self.name = name
 
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'name': self.name}
+
     def __eq__(self, other):
         """Overrides the default implementation"""
         if isinstance(other, StatePlace):
@@ -23,6 +42,9 @@ class StateTransition(object):
         self.id = id
         self.name = name
 
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'name': self.name}
+
     def __eq__(self, other):
         """Overrides the default implementation"""
         if isinstance(other, StateTransition):
@@ -40,6 +62,9 @@ class StateEdge(object):
         self.source = source
         self.target = target
 
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'source': self.source, 'target': self.target}
+
     def __eq__(self, other):
         """Overrides the default implementation"""
         if isinstance(other, StateEdge):
@@ -74,8 +99,12 @@ class PetriNetState(object):
         d = jsonpickle.decode(json_str)
         return cls(d['log'], d['places'], d['transactions'], d['edges'])
 
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'places': [p.to_dict() for p in self.places],
+                'transitions': [t.to_dict() for t in self.transitions], 'edges': [e.to_dict() for e in self.edges]}
+
     def to_json(self) -> str:
-        return jsonpickle.encode(self, unpicklable=False)
+        return encode_json(self.to_dict())
 
 
 class Update(object):
@@ -96,9 +125,68 @@ class Update(object):
         return cls(d['id'], d['new_places'], d['removed_places'], d['new_transactions'], d['removed_transactions'],
                    d['new_edges'], d['removed_edges'])
 
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'new_places': [p.to_dict() for p in self.new_places],
+                'new_transitions': [t.to_dict() for t in self.new_transitions],
+                'new_edges': [e.to_dict() for e in self.new_edges],
+                'removed_places': [p.to_dict() for p in self.removed_places],
+                'removed_transitions': [t.to_dict() for t in self.removed_transitions],
+                'removed_edges': [e.to_dict() for e in self.removed_edges]}
+
     def to_json(self) -> str:
-        return jsonpickle.encode(self, unpicklable=False)
+        return encode_json(self.to_dict())
 
     def is_not_empty(self) -> bool:
         return self.new_places or self.new_transitions or self.new_edges or self.removed_places or \
                self.removed_transitions or self.removed_edges or False  # or False to make expression boolean
+
+    def merge(self, later: 'Update') -> 'Update':
+        """Combine this update with a later one into a single update with the same net effect. Elements added by
+        this update and removed by the later one cancel out. An element that was removed and added again is kept in
+        both, unless it came back unchanged, as it may have been registered with a new ID."""
+        return Update(later.id, *merge_elements(self.new_places, self.removed_places, later.new_places, later.removed_places),
+                      *merge_elements(self.new_transitions, self.removed_transitions, later.new_transitions, later.removed_transitions),
+                      *merge_elements(self.new_edges, self.removed_edges, later.new_edges, later.removed_edges))
+
+
+def merge_elements(new: Set, removed: Set, later_new: Set, later_removed: Set) -> Tuple[Set, Set]:
+    added: Dict = {e: e for e in new}
+    gone: Dict = {e: e for e in removed}
+    for e in later_removed:
+        if e in added:
+            del added[e]
+        else:
+            gone[e] = e
+    for e in later_new:
+        if e in gone and gone[e].to_dict() == e.to_dict():
+            del gone[e]
+        else:
+            added[e] = e
+    return set(added.values()), set(gone.values())
+
+
+class UpdateQueue:
+    """Pending model updates of a miner, merged into one net update, so updates that weren't broadcasted yet
+    don't pile up while broadcasting falls behind. Has the interface of the queue it replaces."""
+    def __init__(self):
+        self.pending: Optional[Update] = None
+        self.merged = 0  # Number of updates that were merged into a pending one
+
+    def put(self, update: Update):
+        if self.pending is None:
+            self.pending = update
+        else:
+            self.pending = self.pending.merge(update)
+            self.merged += 1
+
+    def get(self, *args, **kwargs) -> Update:
+        if self.pending is None:
+            raise Empty
+        update, self.pending = self.pending, None
+        return update
+
+    def empty(self) -> bool:
+        return self.pending is None
+
+    def qsize(self) -> int:
+        return 0 if self.pending is None else 1
@@ -0,0 +1,109 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+from collections import Counter
+import logging
+import mmap
+import json
+import os
+
+import numpy as np
+from pm4py.objects.log.importer.xes import importer as xes_importer
+
+XES_CACHE_DIR = os.environ.get('XES_CACHE_DIR', '../xes-cache')
+MAGIC = b'XESVAR01'
+
+# Reference logs opened by this process, by XES file
+reference_logs: Dict[str, 'ReferenceLog'] = {}
+
+
+class ReferenceLog:
+    """The variants of a reference XES log with their counts, memory-mapped from its cache file.
+
+    The cache file holds a JSON header (the size and mtime of the XES file it was built from, and the activity
+    names), followed by three arrays: the trace count of each variant (most frequent first), the offset of each
+    variant in the activity IDs, and the activity IDs of all variants. Processes mapping the same file share its pages."""
+    def __init__(self, file: str):
+        with open(file, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{file} is not a reference log cache file')
+        header_length = int.from_bytes(self.buffer[8:16], 'little')
+        self.header = json.loads(self.buffer[16:16 + header_length])
+        self.activities: List[str] = self.header['activities']
+
+        offset = align(16 + header_length)
+        variants, events = self.header['variants'], self.header['events']
+        self.counts = np.frombuffer(self.buffer, dtype=np.int64, count=variants, offset=offset)
+        self.offsets = np.frombuffer(self.buffer, dtype=np.int64, count=variants + 1, offset=offset + 8 * variants)
+        self.ids = np.frombuffer(self.buffer, dtype=np.int32, count=events, offset=offset + 8 * (2 * variants + 1))
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def traces(self) -> int:
+        return int(self.counts.sum())
+
+    def variant(self, i: int) -> Tuple[str, ...]:
+        return tuple(self.activities[a] for a in self.ids[self.offsets[i]:self.offsets[i + 1]])
+
+    def variants(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[Tuple[str, ...], int]]:
+        """Iterate over the variants with their trace counts, most frequent first."""
+        for i in range(start, len(self) if stop is None else min(stop, len(self))):
+            yield self.variant(i), int(self.counts[i])
+
+    def is_built_from(self, xes_file: str) -> bool:
+        stat = os.stat(xes_file)
+        return self.header['source_size'] == stat.st_size and self.header['source_mtime_ns'] == stat.st_mtime_ns
+
+
+def align(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+def cache_file(xes_file: str) -> str:
+    return f'{XES_CACHE_DIR}/{os.path.splitext(os.path.basename(xes_file))[0]}.variants'
+
+
+def build_cache(xes_file: str, file: str):
+    """Parse a XES file once, and write its variants to a cache file."""
+    stat = os.stat(xes_file)
+    parameters = {xes_importer.Variants.ITERPARSE.value.Parameters.TIMESTAMP_SORT: True,
+                  xes_importer.Variants.ITERPARSE.value.Parameters.SHOW_PROGRESS_BAR: False}
+    log = xes_importer.apply(xes_file, variant=xes_importer.Variants.ITERPARSE, parameters=parameters)
+    variants = Counter(tuple(e['concept:name'] for e in trace) for trace in log).most_common()
+    del log
+
+    activity_ids: Dict[str, int] = {}
+    ids = [activity_ids.setdefault(a, len(activity_ids)) for variant, _ in variants for a in variant]
+    offsets = np.cumsum([0] + [len(variant) for variant, _ in variants], dtype=np.int64)
+    header = json.dumps({'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns, 'activities': list(activity_ids),
+                         'variants': len(variants), 'events': len(ids)}).encode()
+
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(f'{file}.{os.getpid()}.tmp', 'wb') as f:
+        f.write(MAGIC + len(header).to_bytes(8, 'little') + header)
+        f.write(b'\0' * (align(16 + len(header)) - 16 - len(header)))
+        f.write(np.array([count for _, count in variants], dtype=np.int64).tobytes())
+        f.write(offsets.tobytes())
+        f.write(np.array(ids, dtype=np.int32).tobytes())
+    os.replace(f'{file}.{os.getpid()}.tmp', file)
+    logging.info(f'Cached {len(variants)} variants of {xes_file} in {file}.')
+
+
+def open_reference_log(xes_file: str) -> ReferenceLog:
+    """Open the cached variants of a XES file, (re)building the cache if the XES file changed since it was built."""
+    reference_log = reference_logs.get(xes_file)
+    if reference_log is not None and reference_log.is_built_from(xes_file):
+        return reference_log
+
+    file = cache_file(xes_file)
+    try:
+        reference_log = ReferenceLog(file)
+        if not reference_log.is_built_from(xes_file):
+            reference_log = None
+    except (OSError, ValueError, KeyError):
+        reference_log = None
+    if reference_log is None:
+        build_cache(xes_file, file)
+        reference_log = ReferenceLog(file)
+    reference_logs[xes_file] = reference_log
+    return reference_log
@@ -0,0 +1,138 @@
+from typing import Dict, Optional, Set, Tuple
+from ws_connection_manager import ConnectionManager, Message
+from petri_net_state import encode_json
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+from websockets.client import connect
+from websockets.exceptions import WebSocketException
+import asyncio
+import logging
+import httpx
+import json
+
+# Model elements of an update, with the key that identifies an element across updates (see petri_net_state)
+ELEMENTS = {'places': lambda e: e['name'], 'transitions': lambda e: e['name'],
+            'edges': lambda e: (e['source'], e['target'])}
+
+
+def miner_process_error(e: httpx.HTTPError) -> HTTPException:
+    """The error to answer a request with that couldn't be forwarded to the miner process."""
+    logging.warning(f'Request to the miner process failed: {e!r}')
+    if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return HTTPException(status_code=503, detail='The miner process is unavailable, retry later.')
+    return HTTPException(status_code=502, detail='The request to the miner process failed.')
+
+
+class UpdateRelay:
+    """Relays the model updates of the miner process to the WebSocket clients of a web worker.
+    Each log with connected clients has a single upstream WebSocket subscription to the miner process,
+    and a mirror of the model that is used to send the complete model to newly connected clients."""
+    def __init__(self, miner_address: str, ws_manager: ConnectionManager):
+        self.miner_address = miner_address
+        self.ws_manager = ws_manager
+        self.client = httpx.AsyncClient(base_url=miner_address, timeout=60)
+        self.models: Dict[str, Dict[str, dict]] = {}  # Per log and element type: elements by key
+        self.complete_updates: Dict[str, Message] = {}  # Encoded mirrored model per log, until it changes
+        self.subscriptions: Dict[str, asyncio.Task] = {}
+        self.logs: Set[str] = set()  # Logs the miner process is known to have
+        self.logs_request: Optional[asyncio.Task] = None
+
+    async def forward(self, request: Request, timeout: Optional[float] = None) -> Response:
+        """Forward an HTTP request to the miner process, and return its response.
+        Requests time out after the timeout of the client, unless a longer timeout in seconds is given."""
+        headers = {k: v for k, v in request.headers.items() if k in ('x-secret', 'content-type')}
+        try:
+            result = await self.client.request(request.method, request.url.path, params=request.query_params,
+                                               headers=headers, content=request.stream(),
+                                               timeout=timeout if timeout is not None else self.client.timeout)
+        except httpx.HTTPError as e:
+            raise miner_process_error(e)
+        return Response(content=result.content, status_code=result.status_code,
+                        media_type=result.headers.get('content-type'),
+                        headers={k: v for k, v in result.headers.items() if k == 'retry-after'})
+
+    async def has_log(self, log: str) -> bool:
+        """Check whether the miner process has a miner for a log. Miners aren't removed, so known logs are cached,
+        and the logs are only requested from the miner process for an unknown log, once for concurrent checks."""
+        if log not in self.logs:
+            if self.logs_request is None:
+                self.logs_request = asyncio.create_task(self.request_logs())
+            try:
+                await asyncio.shield(self.logs_request)
+            except httpx.HTTPError as e:
+                raise miner_process_error(e)
+        return log in self.logs
+
+    async def request_logs(self):
+        try:
+            result = await self.client.get('/logs')
+            if result.is_success:
+                self.logs.update(result.json())
+        finally:
+            self.logs_request = None
+
+    def subscribe(self, log: str):
+        """Make sure updates of a log are relayed, as long as the log has connected clients."""
+        if log not in self.subscriptions:
+            self.subscriptions[log] = asyncio.create_task(self.relay_updates(log))
+
+    def latest_complete_update(self, log: str) -> Optional[Message]:
+        """Get the complete mirrored model of a log as an update, or None if it wasn't received yet."""
+        if log not in self.models:
+            return None
+        if log not in self.complete_updates:
+            model = self.models[log]
+            self.complete_updates[log] = Message(encode_json({'id': log, **{f'new_{t}': list(model[t].values()) for t in ELEMENTS},
+                                                              **{f'removed_{t}': [] for t in ELEMENTS}}))
+        return self.complete_updates[log]
+
+    async def relay_updates(self, log: str):
+        address = self.miner_address.replace('http', 'ws', 1) + f'/ws/{log}'
+        try:
+            while self.ws_manager.connection_count(log) > 0:
+                try:
+                    async with connect(address) as upstream:
+                        complete = True  # The miner sends the complete model first
+                        async for message in upstream:
+                            if isinstance(message, bytes):
+                                message = message.decode()
+                            update, changed = self.apply(log, json.loads(message), complete)
+                            if changed:
+                                self.ws_manager.broadcast(encode_json(update) if complete else message, log)
+                            complete = False
+                            if self.ws_manager.connection_count(log) == 0:
+                                break
+                except (OSError, WebSocketException) as e:
+                    logging.warning(f'Relaying updates of "{log}" from the miner process failed: {e}')
+                if self.ws_manager.connection_count(log) > 0:
+                    await asyncio.sleep(1)
+        finally:
+            del self.subscriptions[log]
+            self.models.pop(log, None)
+            self.complete_updates.pop(log, None)
+
+    def apply(self, log: str, update: dict, complete: bool) -> Tuple[dict, bool]:
+        """Apply an update to the mirrored model of a log. A complete model (sent when subscribing, also after a
+        reconnect) is turned into the difference to the mirrored model, so clients only receive what changed."""
+        if log not in self.models:
+            self.models[log] = {t: {} for t in ELEMENTS}
+        model = self.models[log]
+        if complete:
+            received = {t: {key(e): e for e in update[f'new_{t}']} for t, key in ELEMENTS.items()}
+            update = {'id': log, **{f'new_{t}': [e for k, e in received[t].items() if model[t].get(k) != e] for t in ELEMENTS},
+                      **{f'removed_{t}': [e for k, e in model[t].items() if k not in received[t]] for t in ELEMENTS}}
+
+        for t, key in ELEMENTS.items():
+            for e in update[f'removed_{t}']:
+                model[t].pop(key(e), None)
+            for e in update[f'new_{t}']:
+                model[t][key(e)] = e
+        changed = any(update[f'new_{t}'] or update[f'removed_{t}'] for t in ELEMENTS)
+        if changed:
+            self.complete_updates.pop(log, None)
+        return update, changed
+
+    async def close(self):
+        for task in list(self.subscriptions.values()):
+            task.cancel()
+        await self.client.aclose()
@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+from collections import OrderedDict
+from urllib.parse import quote
+from miner import export_to_plnm
+import asyncio
+import logging
+import metrics
+import tracing
+import shutil
+import time
+import os
+
+from pm4py.objects.petri_net.obj import PetriNet, Marking
+from pm4py.visualization.petri_net import visualizer as pn_visualizer
+
+RENDER_DIR = os.environ.get('RENDER_DIR', '../pn_images')
+
+# A model to render: its content hash, model version and Petri net
+Model = Tuple[int, int, Tuple[PetriNet, Marking, Marking]]
+
+RENDERS = metrics.Counter('miner_renders_total', 'Models of a log rendered to SVG and PNML.', ['log'])
+RENDERS_SKIPPED = metrics.Counter('miner_renders_skipped_total', 'Models of a log replaced by a newer one before they were rendered.', ['log'])
+RENDER_SECONDS = metrics.Histogram('miner_render_seconds', 'Duration of rendering a model to SVG and PNML.', ['log'])
+
+
+def render_model(petri_net: Tuple[PetriNet, Marking, Marking], path: str):
+    """Render a Petri net to a PNML file and an SVG image with graphviz, at a path without extension."""
+    net, initial, final = petri_net
+    export_to_plnm(net, initial, final, f'{path}.pnml')
+    parameters = {pn_visualizer.Variants.WO_DECORATION.value.Parameters.FORMAT: 'svg'}
+    gviz = pn_visualizer.apply(net, initial, final, parameters=parameters)
+    pn_visualizer.save(gviz, f'{path}.svg')
+
+
+def remove_render(path: str):
+    for extension in ('svg', 'pnml'):
+        try:
+            os.remove(f'{path}.{extension}')
+        except OSError:
+            pass
+
+
+class ModelRenderer:
+    """Renders the models of logs in a background thread pool. Each log renders one model at a time, and only the
+    latest model that is waiting, so versions are skipped while rendering falls behind. Models are identified by
+    their content, so a model that is rendered already isn't rendered again, and the last RENDER_KEEP renders of
+    each log are kept in RENDER_DIR/<log>/<model version>.svg and .pnml."""
+    def __init__(self, directory: str = RENDER_DIR, keep: int = 10, workers: int = 2):
+        self.directory = directory
+        self.keep = max(1, keep)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='render')
+        self.renders: Dict[str, OrderedDict[int, str]] = {}  # Per log: path of the render by content hash, oldest first
+        self.failed: Dict[str, int] = {}  # Per log: content hash of the model that couldn't be rendered last
+        self.pending: Dict[str, Model] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.rendered: Dict[str, asyncio.Event] = {}  # Set whenever a render of a log finished
+
+    def request(self, log: str, model: Model):
+        """Queue a model for rendering, replacing the model of the log that is still waiting, if any."""
+        content_hash = model[0]
+        if content_hash in self.renders.get(log, {}):
+            self.renders[log].move_to_end(content_hash)
+            return
+        if log in self.pending and self.pending[log][0] != content_hash:
+            RENDERS_SKIPPED.inc(log)
+        self.pending[log] = model
+        if log not in self.tasks:
+            self.tasks[log] = asyncio.create_task(self.run(log))
+
+    async def run(self, log: str):
+        loop = asyncio.get_running_loop()
+        try:
+            if log not in self.renders:  # Drop the renders of previous runs, which are never served
+                await loop.run_in_executor(self.executor, shutil.rmtree, os.path.join(self.directory, quote(log, safe='')), True)
+                self.renders[log] = OrderedDict()
+            while log in self.pending:
+                content_hash, version, petri_net = self.pending.pop(log)
+                path = os.path.join(self.directory, quote(log, safe=''), str(version))
+                start = time.perf_counter()
+                try:
+                    with tracing.span('render', log, version=version):
+                        await loop.run_in_executor(self.executor, render_model, petri_net, path)
+                    RENDER_SECONDS.observe(time.perf_counter() - start, log)
+                    RENDERS.inc(log)
+                    logging.info(f'Rendered model version {version} of "{log}" to {path}.svg')
+                    renders = self.renders[log]
+                    renders[content_hash] = path
+                    while len(renders) > self.keep:
+                        await loop.run_in_executor(self.executor, remove_render, renders.popitem(last=False)[1])
+                except Exception as e:
+                    logging.error(f'Rendering model version {version} of "{log}" failed: {e}')
+                    self.failed[log] = content_hash
+                if log in self.rendered:
+                    self.rendered.pop(log).set()
+        finally:
+            del self.tasks[log]
+
+    async def render(self, log: str, current: Callable[[], Optional[Model]]) -> Optional[str]:
+        """Get the path (without extension) of the render of the current model of a log, rendering it if necessary.
+        Returns None if the log has no model yet, and raises a RuntimeError if the model couldn't be rendered."""
+        while True:
+            model = current()
+            if model is None:
+                return None
+            if model[0] in self.renders.get(log, {}):
+                self.renders[log].move_to_end(model[0])
+                return self.renders[log][model[0]]
+            if self.failed.get(log) == model[0] and log not in self.tasks:
+                raise RuntimeError(f'Rendering the model of "{log}" failed.')
+            self.failed.pop(log, None)
+            self.request(log, model)
+            if log not in self.rendered:
+                self.rendered[log] = asyncio.Event()
+            await self.rendered[log].wait()
+
+    def close(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        self.executor.shutdown(wait=False)
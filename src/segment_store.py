@@ -0,0 +1,242 @@
+from typing import AsyncIterator, Dict, Iterator, List, Tuple
+from urllib.parse import quote, unquote
+from event_store import EventStore
+from mqtt_event import MqttEvent
+import numpy as np
+import threading
+import asyncio
+import metrics
+import logging
+import struct
+import mmap
+import time
+import os
+
+EVENT_STORE_DIR = os.environ.get('EVENT_STORE_DIR', '../event-store')
+SEGMENT_SIZE = int(os.environ.get('SEGMENT_SIZE', 64 * 2 ** 20))  # Bytes after which a new segment is started
+SEGMENT_INDEX_INTERVAL = int(os.environ.get('SEGMENT_INDEX_INTERVAL', 1024))  # Records per sparse index entry
+EVENT_STORE_FSYNC = os.environ.get('EVENT_STORE_FSYNC', 'True') == 'True'
+
+# Record: payload length, then the payload: rowid, timestamp, lengths of the UTF-8 process and activity, and both strings
+LENGTH = struct.Struct('<I')
+HEADER = struct.Struct('<qdII')
+# Index entry: rowid of the record at the offset
+INDEX_ENTRY = struct.Struct('<qq')
+INDEX_DTYPE = np.dtype([('rowid', '<i8'), ('offset', '<i8')])
+
+STORE_APPEND_SECONDS = metrics.Histogram('miner_event_store_append_seconds',
+                                         'Duration of appending a batch of events to the segment store, including fsync.')
+STORE_REPLAYED_EVENTS = metrics.Counter('miner_event_store_replayed_events_total', 'Events replayed from the segment store.')
+
+
+def decode_records(buffer, offset: int, end: int) -> Iterator[Tuple[int, int, float, str, str]]:
+    """Decode the complete records between two offsets of a segment as (offset, rowid, timestamp, process, activity)."""
+    while offset + LENGTH.size + HEADER.size <= end:
+        length, = LENGTH.unpack_from(buffer, offset)
+        if offset + LENGTH.size + length > end:
+            break  # Incomplete record, torn by a crash
+        rowid, timestamp, process_length, activity_length = HEADER.unpack_from(buffer, offset + LENGTH.size)
+        start = offset + LENGTH.size + HEADER.size
+        yield (offset, rowid, timestamp, str(buffer[start:start + process_length], 'utf-8'),
+               str(buffer[start + process_length:start + process_length + activity_length], 'utf-8'))
+        offset += LENGTH.size + length
+
+
+def encode_record(rowid: int, event: MqttEvent) -> bytes:
+    process, activity = event.process.encode(), event.activity.encode()
+    return LENGTH.pack(HEADER.size + len(process) + len(activity)) + \
+        HEADER.pack(rowid, event.timestamp, len(process), len(activity)) + process + activity
+
+
+class SegmentLog:
+    """Append-only log of the events of one event log, split into length-prefixed segment files named by the rowid of
+    their first record. Each segment has a sparse index with an entry every SEGMENT_INDEX_INTERVAL records, used to
+    start a replay close to a rowid. A torn record at the end of the last segment is dropped on opening."""
+    def __init__(self, directory: str, fsync: bool = EVENT_STORE_FSYNC):
+        self.directory = directory
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.segments: List[int] = sorted(int(f[:-4]) for f in os.listdir(directory) if f.endswith('.seg'))
+        self.last_rowid = 0
+        self.size = 0  # Bytes and records of the last segment
+        self.count = 0
+        if self.segments:
+            self.recover()
+        else:
+            self.segments.append(1)
+        self.data_file = open(self.path(self.segments[-1], 'seg'), 'ab')
+        self.index_file = open(self.path(self.segments[-1], 'idx'), 'ab')
+
+    def path(self, segment: int, extension: str) -> str:
+        return os.path.join(self.directory, f'{segment:020d}.{extension}')
+
+    def read_index(self, segment: int) -> np.ndarray:
+        with open(self.path(segment, 'idx'), 'rb') as f:
+            data = f.read()
+        return np.frombuffer(data[:len(data) - len(data) % INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+
+    def recover(self):
+        """Restore the state of the last segment from its index, and the records after its last index entry,
+        truncating a torn record and rebuilding index entries that didn't reach the disk."""
+        segment = self.segments[-1]
+        if not os.path.exists(self.path(segment, 'idx')):
+            open(self.path(segment, 'idx'), 'wb').close()
+        with open(self.path(segment, 'seg'), 'rb') as f:
+            data = f.read()
+        index = self.read_index(segment)
+        index = index[index['offset'] < len(data)]
+        if len(index):
+            start, self.count = int(index[-1]['offset']), (len(index) - 1) * SEGMENT_INDEX_INTERVAL
+            self.last_rowid = int(index[-1]['rowid']) - 1
+        else:
+            start, self.last_rowid = 0, segment - 1
+        entries = [INDEX_ENTRY.pack(*entry) for entry in index.tolist()]
+        self.size = start
+        for offset, rowid, timestamp, process, activity in decode_records(data, start, len(data)):
+            if self.count % SEGMENT_INDEX_INTERVAL == 0 and offset != start or not entries:
+                entries.append(INDEX_ENTRY.pack(rowid, offset))
+            self.last_rowid = rowid
+            self.count += 1
+            self.size = offset + LENGTH.size + HEADER.size + len(process.encode()) + len(activity.encode())
+        if len(index) and self.size == start:
+            entries.pop()  # The record of the last index entry is torn, the entry is written again with the next append
+        if self.size < len(data):
+            logging.warning(f'Dropping {len(data) - self.size} bytes of a torn record at the end of {self.path(segment, "seg")}')
+            os.truncate(self.path(segment, 'seg'), self.size)
+        with open(self.path(segment, 'idx'), 'wb') as f:
+            f.write(b''.join(entries))
+
+    def append(self, events: List[MqttEvent]):
+        """Append events, assigning them consecutive rowids, and make them durable with a single fsync.
+        The rowids are set on the events."""
+        with self.lock:
+            data, index = bytearray(), bytearray()
+            for event in events:
+                if self.size + len(data) >= SEGMENT_SIZE and self.count:
+                    self.write(data, index)
+                    data, index = bytearray(), bytearray()
+                    self.roll()
+                self.last_rowid += 1
+                if self.count % SEGMENT_INDEX_INTERVAL == 0:
+                    index += INDEX_ENTRY.pack(self.last_rowid, self.size + len(data))
+                data += encode_record(self.last_rowid, event)
+                event.rowid = self.last_rowid
+                self.count += 1
+            self.write(data, index)
+            self.sync()
+
+    def write(self, data: bytearray, index: bytearray):
+        self.data_file.write(data)
+        self.data_file.flush()
+        self.index_file.write(index)
+        self.index_file.flush()
+        self.size += len(data)
+
+    def sync(self):
+        if self.fsync:
+            os.fsync(self.data_file.fileno())
+            os.fsync(self.index_file.fileno())
+
+    def roll(self):
+        """Close the last segment, and start a new one with the next rowid."""
+        self.sync()
+        self.data_file.close()
+        self.index_file.close()
+        self.segments.append(self.last_rowid + 1)
+        self.data_file = open(self.path(self.segments[-1], 'seg'), 'ab')
+        self.index_file = open(self.path(self.segments[-1], 'idx'), 'ab')
+        self.size = self.count = 0
+
+    def replay_plan(self, after_rowid: int) -> Tuple[List[Tuple[int, int, int]], int]:
+        """Get the segments to replay as (segment, start offset, end offset), skipping the records before the last
+        index entry that only precedes records with a rowid of at most after_rowid, and the last rowid to replay,
+        so events appended during the replay are left out."""
+        with self.lock:
+            segments = list(self.segments)
+            sizes = [os.path.getsize(self.path(s, 'seg')) for s in segments[:-1]] + [self.size]
+            indexes = [self.read_index(s) for s in segments]
+            end_rowid = self.last_rowid
+        positions = [(i, int(offset)) for i, index in enumerate(indexes) for offset in index['offset']]
+        rowids = np.concatenate([index['rowid'] for index in indexes])
+        skip = int(np.searchsorted(rowids, after_rowid + 1, side='right')) - 1
+        first, offset = positions[skip] if skip >= 0 else (0, 0)
+        return [(segments[i], offset if i == first else 0, sizes[i]) for i in range(first, len(segments))], end_rowid
+
+    def close(self):
+        with self.lock:
+            self.data_file.close()
+            self.index_file.close()
+
+
+class SegmentEventStore(EventStore):
+    """Event store keeping each event log in a local SegmentLog, in a directory per log. Appends of a batch are made
+    durable with one fsync per log (EVENT_STORE_FSYNC), and replays decode the memory-mapped segments sequentially."""
+    def __init__(self, directory: str = EVENT_STORE_DIR):
+        self.directory = directory
+        self.logs: Dict[str, SegmentLog] = {}
+        self.logs_lock = threading.Lock()
+
+    def get_log(self, log: str) -> SegmentLog:
+        with self.logs_lock:
+            if log not in self.logs:
+                self.logs[log] = SegmentLog(os.path.join(self.directory, quote(log, safe='')))
+            return self.logs[log]
+
+    async def get_event_logs(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        logs = sorted(unquote(d) for d in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, d)))
+        logging.info(f'Existing event logs in event store: {logs}')
+        return logs
+
+    async def iterate_events(self, log: str, page_size: int, after_rowid: int = 0) -> AsyncIterator[List[dict]]:
+        if not os.path.isdir(os.path.join(self.directory, quote(log, safe=''))):
+            return
+        segment_log = self.get_log(log)
+        plan, end_rowid = segment_log.replay_plan(after_rowid)
+        loaded, start = 0, time.perf_counter()
+        page: List[dict] = []
+        for segment, offset, end in plan:
+            if offset >= end:
+                continue
+            with open(segment_log.path(segment, 'seg'), 'rb') as f, mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as m:
+                for _, rowid, timestamp, process, activity in decode_records(m, offset, end):
+                    if rowid > end_rowid:
+                        break
+                    if rowid <= after_rowid:
+                        continue
+                    page.append({'rowid': rowid, 'timestamp': timestamp, 'process': process, 'activity': activity})
+                    if len(page) == page_size:
+                        loaded += len(page)
+                        yield page
+                        page = []
+                        await asyncio.sleep(0)
+        if page:
+            loaded += len(page)
+            yield page
+        STORE_REPLAYED_EVENTS.inc(amount=loaded)
+        logging.info(f'Replayed {loaded} events of event log {log} from the event store in {time.perf_counter() - start:.2f}s')
+
+    async def add_events(self, events: List[MqttEvent]) -> List[MqttEvent]:
+        by_log: Dict[str, List[MqttEvent]] = {}
+        for event in events:
+            by_log.setdefault(str(event.source), []).append(event)
+        start = time.perf_counter()
+        failed = await asyncio.get_running_loop().run_in_executor(None, self.append, by_log)
+        STORE_APPEND_SECONDS.observe(time.perf_counter() - start)
+        return failed
+
+    def append(self, by_log: Dict[str, List[MqttEvent]]) -> List[MqttEvent]:
+        failed = []
+        for log, events in by_log.items():
+            try:
+                self.get_log(log).append(events)
+            except Exception as e:
+                logging.error(f'Couldn\'t append {len(events)} events to the event store for event log {log}: {e}')
+                failed.extend(events)
+        return failed
+
+    async def close(self):
+        for segment_log in self.logs.values():
+            segment_log.close()
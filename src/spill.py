@@ -0,0 +1,63 @@
+from typing import Iterable, List
+from urllib.parse import quote
+from mqtt_event import MqttEvent
+import logging
+import json
+import os
+
+SPILL_DIR = os.environ.get('SPILL_DIR', '../spill')
+
+
+class SpillSegment:
+    """On-disk overflow segment of the events of a log, one JSON row per line. Events are appended at the end and
+    read back in the same order, and the file is truncated whenever all of its events were read.
+    Spilled events are already persisted by the event writer, so a segment left over from a previous run is discarded."""
+    def __init__(self, log: str):
+        os.makedirs(SPILL_DIR, exist_ok=True)
+        self.file_name = os.path.join(SPILL_DIR, f'{quote(log, safe="")}.ndjson')
+        self.file = open(self.file_name, 'w+b')
+        self.read_offset = 0
+        self.pending = 0
+
+    def __len__(self) -> int:
+        return self.pending
+
+    def append(self, events: Iterable[MqttEvent]):
+        lines = [json.dumps({'timestamp': e.timestamp, 'process': e.process, 'activity': e.activity},
+                            separators=(',', ':')).encode() + b'\n' for e in events]
+        self.file.seek(0, os.SEEK_END)
+        self.file.writelines(lines)
+        self.file.flush()
+        self.pending += len(lines)
+
+    def read(self, limit: int) -> List[dict]:
+        """Read at most limit of the oldest events that weren't read yet, as rows. Lines that aren't valid events
+        are logged and skipped."""
+        self.file.seek(self.read_offset)
+        rows = []
+        read = 0
+        while read < limit:
+            line = self.file.readline()
+            if not line:
+                break
+            read += 1
+            try:
+                row = json.loads(line)
+                rows.append({'timestamp': float(row['timestamp']), 'process': str(row['process']),
+                             'activity': str(row['activity'])})
+            except (ValueError, KeyError, TypeError) as e:
+                logging.error(f'Skipping an invalid event in spill segment {self.file_name}: {e}')
+        self.read_offset = self.file.tell()
+        self.pending -= read
+        if self.pending <= 0:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_offset = self.pending = 0
+        return rows
+
+    def close(self):
+        try:
+            self.file.close()
+            os.remove(self.file_name)
+        except OSError as e:
+            logging.error(f'Couldn\'t remove spill segment {self.file_name}: {e}')
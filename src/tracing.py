@@ -0,0 +1,69 @@
+from typing import Deque, Dict, Optional, Tuple
+from contextlib import contextmanager
+from collections import Counter, deque
+from types import FrameType
+import threading
+import time
+import sys
+import os
+
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', 10000))
+
+# Most recent spans: (name, track, start and duration in microseconds, arguments)
+spans: Deque[Tuple[str, str, int, int, Optional[dict]]] = deque(maxlen=TRACE_BUFFER_SIZE)
+profiling = threading.Lock()
+
+
+@contextmanager
+def span(name: str, track: Optional[str] = None, **args):
+    """Record the duration of a block in the span ring buffer. Spans on the same track (e.g. a log, so the stages of
+    its update cycles line up, by default the current thread) are shown on one timeline row."""
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        end = time.perf_counter_ns()
+        spans.append((name, track or threading.current_thread().name, start // 1000, (end - start) // 1000, args or None))
+
+
+def chrome_trace() -> dict:
+    """Get the recorded spans in the Chrome trace event format, viewable in chrome://tracing or Perfetto."""
+    pid = os.getpid()
+    tracks: Dict[str, int] = {}
+    events = []
+    for name, track, start, duration, args in list(spans):
+        if track not in tracks:
+            tracks[track] = len(tracks) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tracks[track], 'args': {'name': track}})
+        event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': tracks[track], 'ts': start, 'dur': duration}
+        if args:
+            event['args'] = args
+        events.append(event)
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def profile(seconds: float, interval: float = 0.005) -> str:
+    """Sample the stacks of all threads of this process for some seconds, and return how often each stack was seen
+    in the collapsed format of flame graph tools ('outer;inner count' per line). One profile runs at a time."""
+    if not profiling.acquire(blocking=False):
+        raise RuntimeError('A profile is already running.')
+    try:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, top in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                frame: Optional[FrameType] = top
+                while frame is not None:
+                    stack.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+    finally:
+        profiling.release()
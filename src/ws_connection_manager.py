@@ -1,31 +1,155 @@
-from typing import List, Tuple
+from typing import Callable, Deque, Dict, Optional, Union
+from collections import deque
 from fastapi import WebSocket
+import metrics
+import asyncio
 import logging
+import time
+import zlib
+
+# Clients offering this subprotocol receive messages as zlib-compressed JSON in binary frames
+BINARY_SUBPROTOCOL = 'json.zlib'
+
+WS_DELIVERY_SECONDS = metrics.Histogram('miner_ws_delivery_seconds', 'Time from broadcasting a message until it was sent to a client.', ['log'])
+WS_DROPPED_MESSAGES = metrics.Counter('miner_ws_dropped_messages_total', 'Messages skipped for lagging clients, which are resynced instead.', ['log'])
+WS_DISCONNECTS = metrics.Counter('miner_ws_forced_disconnects_total', 'Clients disconnected for lagging behind or failed sends.', ['log', 'reason'])
+
+
+class Message:
+    """A message that is encoded once for all clients: as JSON text, and compressed only if a binary client needs it."""
+    def __init__(self, text: str):
+        self.text = text
+        self.compressed: Optional[bytes] = None
+        self.broadcast_at: Optional[float] = None
+
+    def binary(self) -> bytes:
+        if self.compressed is None:
+            self.compressed = zlib.compress(self.text.encode())
+        return self.compressed
+
+
+class Client:
+    """A WebSocket connection with a bounded queue of outgoing messages, which is sent by its own task."""
+    def __init__(self, websocket: WebSocket, log: str, binary: bool):
+        self.websocket = websocket
+        self.log = log
+        self.binary = binary
+        self.queue: Deque[Message] = deque()
+        self.ready = asyncio.Event()
+        self.resync = True  # The first message of a client is the complete model
+        self.overflows = 0  # Number of resyncs since the queue of the client was last drained
+        self.lagging = False
+        self.task: Optional[asyncio.Task] = None
 
 
 class ConnectionManager:
     """Handles multiple WebSocket connections at once.
-    From documentation: https://fastapi.tiangolo.com/advanced/websockets/"""
-    def __init__(self):
-        self.active_connections: List[Tuple[WebSocket, str]] = []
+    From documentation: https://fastapi.tiangolo.com/advanced/websockets/
+
+    Messages are queued per client and sent concurrently, so a slow client doesn't delay the others.
+    A client whose queue overflows skips its queued messages and is resynced with the complete model,
+    which is produced by the resync function. A client that keeps lagging, or whose send times out, is disconnected."""
+    def __init__(self, resync: Callable[[str], Optional[Message]] = lambda log: None, send_timeout: float = 5,
+                 max_queue: int = 32, max_resyncs: int = 3):
+        self.resync = resync
+        self.send_timeout = send_timeout
+        self.max_queue = max_queue
+        self.max_resyncs = max_resyncs
+        self.connections: Dict[str, Dict[WebSocket, Client]] = {}  # Per log: clients by connection
 
     async def connect(self, websocket: WebSocket, log: str):
-        await websocket.accept()
-        self.active_connections.append((websocket, log))
+        """Accept a connection. Its first message will be the complete model of the log."""
+        binary = BINARY_SUBPROTOCOL in websocket.scope.get('subprotocols', [])
+        await websocket.accept(subprotocol=BINARY_SUBPROTOCOL if binary else None)
+        client = Client(websocket, log, binary)
+        self.connections.setdefault(log, {})[websocket] = client
+        client.task = asyncio.create_task(self.send_messages(client))
+        client.ready.set()
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections = [x for x in self.active_connections if x[0] is not websocket]
-
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        """Send a message to a single connection."""
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str, log: str) -> int:
-        """Broadcast a message to all connections listening to a log."""
-        applicable = [x for x in self.active_connections if x[1] == log]
-        for connection in applicable:
-            try:
-                await connection[0].send_text(message)
-            except Exception as e:
-                logging.error(f'Error while attempting to broadcast message to {connection}: {e}')
-        return len(applicable)
+        for log, clients in self.connections.items():
+            client = clients.get(websocket)
+            if client is not None:
+                self.remove(client)
+                if client.task is not None and client.task is not asyncio.current_task():
+                    client.task.cancel()
+                return
+
+    def remove(self, client: Client):
+        clients = self.connections.get(client.log, {})
+        if clients.pop(client.websocket, None) is not None and not clients:
+            del self.connections[client.log]
+
+    def connection_count(self, log: str) -> int:
+        return len(self.connections.get(log, ()))
+
+    def send_personal_message(self, message: Union[str, Message], websocket: WebSocket):
+        """Queue a message for a single connection."""
+        message = message if isinstance(message, Message) else Message(message)
+        for clients in self.connections.values():
+            if websocket in clients:
+                self.enqueue(clients[websocket], message)
+
+    def broadcast(self, message: Union[str, Message], log: str) -> int:
+        """Queue a message for all connections listening to a log, and return their number."""
+        message = message if isinstance(message, Message) else Message(message)
+        message.broadcast_at = time.monotonic()
+        clients = list(self.connections.get(log, {}).values())
+        for client in clients:
+            self.enqueue(client, message)
+        return len(clients)
+
+    def enqueue(self, client: Client, message: Message):
+        if client.resync:
+            pass  # Already waiting for the complete model, which includes this message
+        elif len(client.queue) < self.max_queue:
+            client.queue.append(message)
+        else:
+            WS_DROPPED_MESSAGES.inc(client.log, amount=len(client.queue) + 1)
+            client.queue.clear()
+            client.overflows += 1
+            if client.overflows > self.max_resyncs:
+                logging.warning(f'Disconnecting WS client {client.websocket.client}, it kept lagging behind on "{client.log}".')
+                WS_DISCONNECTS.inc(client.log, 'lagging')
+                client.lagging = True
+                self.remove(client)
+            else:
+                client.resync = True
+        client.ready.set()
+
+    async def send_messages(self, client: Client):
+        """Send the queued messages of a client, until it disconnects or lags behind."""
+        try:
+            while not client.lagging:
+                await client.ready.wait()
+                client.ready.clear()
+                if client.resync:
+                    client.resync = False
+                    client.queue.clear()
+                    try:
+                        message = self.resync(client.log)
+                    except Exception as e:
+                        logging.error(f'Couldn\'t get the complete model of "{client.log}" for WS client {client.websocket.client}: {e}')
+                        message = None
+                    if message is not None:
+                        client.queue.append(message)
+
+                while client.queue and not client.resync and not client.lagging:
+                    message = client.queue.popleft()
+                    send = client.websocket.send_bytes(message.binary()) if client.binary else client.websocket.send_text(message.text)
+                    await asyncio.wait_for(send, timeout=self.send_timeout)
+                    if message.broadcast_at is not None:
+                        WS_DELIVERY_SECONDS.observe(time.monotonic() - message.broadcast_at, client.log)
+                if not client.queue and not client.resync:
+                    client.overflows = 0
+        except asyncio.TimeoutError:
+            logging.warning(f'Disconnecting WS client {client.websocket.client}, sending timed out after {self.send_timeout}s.')
+            WS_DISCONNECTS.inc(client.log, 'timeout')
+        except Exception as e:
+            logging.error(f'Error while attempting to send message to WS client {client.websocket.client}: {e}')
+            WS_DISCONNECTS.inc(client.log, 'error')
+        self.remove(client)
+        try:
+            await asyncio.wait_for(client.websocket.close(code=1013), timeout=self.send_timeout)  # Try again later
+        except Exception:
+            pass  # The connection is already broken
@@ -0,0 +1,193 @@
+"""Offline benchmark of the miner pipeline: ingest -> discover -> diff -> serialize.
+
+Replays the bundled XES files and synthetic event logs through a Miner in increments, and measures each stage:
+ingested events/s, discovery latency percentiles, diff time, and serialization time and payload size against the
+model size. Results can be stored as a baseline, and later runs fail if a stage got slower than the baseline by
+more than the threshold.
+
+    python benchmark.py                        # Run and compare against benchmark-baseline.json, if it exists
+    python benchmark.py --save-baseline        # Run and store the results as the new baseline
+    python benchmark.py --cases 5000 --activities 40 --concurrency 200 --xes ../xes-files/loan-process.xes
+"""
+from typing import Dict, List, Tuple
+from queue import Queue
+import argparse
+import random
+import time
+import json
+import glob
+import sys
+import os
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+for key, value in {'SAVE_PICTURES': 'False', 'CONFORMANCE_CHECK': 'False', 'SAVE_SNAPSHOTS': 'False',
+                   'LOG_CONFIG_FILE': ''}.items():
+    os.environ.setdefault(key, value)
+
+from mqtt_event import MqttEvent  # noqa: E402
+from miner import Miner  # noqa: E402
+import discovery  # noqa: E402
+
+# Metrics where higher is better, all others are durations where lower is better
+THROUGHPUT_METRICS = {'ingest_events_per_s'}
+
+
+def synthetic_events(cases: int, activities: int, concurrency: int, seed: int = 0) -> List[MqttEvent]:
+    """Generate an event log from a random process, in which each activity has a few possible successors.
+    Up to concurrency cases are running at the same time, so their events interleave."""
+    rng = random.Random(seed)
+    alphabet = [f'Activity {i}' for i in range(activities)]
+    successors = {a: rng.sample(alphabet, min(3, activities)) for a in alphabet}
+    starts = alphabet[:max(1, activities // 10)]
+
+    traces = []
+    for case in range(cases):
+        trace = [rng.choice(starts)]
+        while len(trace) < 40 and rng.random() > 0.1:
+            trace.append(rng.choice(successors[trace[-1]]))
+        traces.append((f'case {case}', trace))
+
+    events, running, timestamp = [], [], 0.0
+    pending = iter(traces)
+    while True:
+        while len(running) < concurrency:
+            case = next(pending, None)
+            if case is None:
+                break
+            running.append((case[0], iter(case[1])))
+        if not running:
+            return events
+        case, trace = running.pop(rng.randrange(len(running)))
+        activity = next(trace, None)
+        if activity is not None:
+            timestamp += 1
+            events.append(MqttEvent(timestamp=timestamp, source='synthetic', process=case, activity=activity))
+            running.append((case, trace))
+
+
+def xes_events(file: str) -> List[MqttEvent]:
+    """Read the events of a XES file, in timestamp order."""
+    from pm4py.objects.log.importer.xes import importer as xes_importer
+    log = xes_importer.apply(file, variant=xes_importer.Variants.ITERPARSE,
+                             parameters={xes_importer.Variants.ITERPARSE.value.Parameters.SHOW_PROGRESS_BAR: False})
+    events = [MqttEvent(timestamp=e['time:timestamp'].timestamp(), source='xes', process=str(trace.attributes['concept:name']),
+                        activity=e['concept:name']) for trace in log for e in trace]
+    events.sort(key=lambda e: e.timestamp)
+    return events
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else 0.0
+
+
+def run(name: str, events: List[MqttEvent], increments: int) -> Dict[str, float]:
+    """Feed events to a miner in increments, updating its model after each increment like the model updater does."""
+    update_queue: Queue = Queue()
+    miner = Miner(name, update_queue)
+    ingest_time, discovery_times, diff_times, serialize_times, payload_bytes = 0.0, [], [], [], 0
+    step = max(1, len(events) // increments)
+    for i in range(0, len(events), step):
+        start = time.perf_counter()
+        miner.append_events_to_stream(events[i:i + step])
+        fingerprint, dfg = miner.dfg_snapshot()
+        ingest_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        petri_net = discovery.discover_petri_net(*dfg)
+        discovery_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        miner.apply_petri_net(fingerprint, petri_net)
+        diff_times.append(time.perf_counter() - start)
+
+        while not update_queue.empty():
+            update = update_queue.get()
+            start = time.perf_counter()
+            payload_bytes += len(update.to_json())
+            serialize_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    complete = miner.latest_complete_update().to_json()
+    complete_time = time.perf_counter() - start
+    state = miner.petri_net_state
+    return {'events': len(events), 'model_elements': len(state.places) + len(state.transitions) + len(state.edges),
+            'ingest_events_per_s': len(events) / ingest_time if ingest_time else 0.0,
+            'discovery_p50_ms': percentile(discovery_times, 50) * 1000, 'discovery_p95_ms': percentile(discovery_times, 95) * 1000,
+            'discovery_max_ms': max(discovery_times) * 1000,
+            'diff_mean_ms': sum(diff_times) / len(diff_times) * 1000,
+            'serialize_mean_ms': sum(serialize_times) / max(1, len(serialize_times)) * 1000,
+            'update_payload_bytes': payload_bytes, 'complete_payload_bytes': len(complete),
+            'complete_serialize_ms': complete_time * 1000}
+
+
+def regressions(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+                threshold: float, min_ms: float) -> List[Tuple[str, str, float, float]]:
+    """Find the stage metrics that got worse than the baseline by more than the threshold (e.g. 0.25 = 25%).
+    Durations below min_ms are ignored, as they are dominated by noise."""
+    found = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            if base is None or not (metric.endswith('_ms') or metric in THROUGHPUT_METRICS):
+                continue
+            if metric in THROUGHPUT_METRICS:
+                worse = value < base / (1 + threshold)
+            else:
+                worse = max(value, base) >= min_ms and value > base * (1 + threshold)
+            if worse:
+                found.append((name, metric, base, value))
+    return found
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--xes', nargs='*', default=sorted(glob.glob(os.path.join(SRC, '..', 'xes-files', '*.xes'))),
+                        help='XES files to replay (default: the bundled xes-files)')
+    parser.add_argument('--cases', type=int, default=2000, help='Cases of the synthetic log (0 to skip it)')
+    parser.add_argument('--activities', type=int, default=20, help='Activity alphabet size of the synthetic log')
+    parser.add_argument('--concurrency', type=int, default=50, help='Concurrently running cases of the synthetic log')
+    parser.add_argument('--increments', type=int, default=20, help='Model updates per log')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per log, the best run of each metric is kept')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark-baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed slowdown against the baseline')
+    parser.add_argument('--min-ms', type=float, default=1, help='Ignore durations below this many milliseconds')
+    args = parser.parse_args()
+
+    workloads = {os.path.splitext(os.path.basename(f))[0]: (lambda f=f: xes_events(f)) for f in args.xes}
+    if args.cases > 0:
+        workloads[f'synthetic-{args.cases}x{args.activities}x{args.concurrency}'] = \
+            lambda: synthetic_events(args.cases, args.activities, args.concurrency)
+
+    results: Dict[str, Dict[str, float]] = {}
+    for name, load in workloads.items():
+        events = load()
+        runs = [run(name, events, args.increments) for _ in range(args.repeat)]
+        results[name] = {metric: (max if metric in THROUGHPUT_METRICS else min)(r[metric] for r in runs) for metric in runs[0]}
+        print(f'{name}:')
+        for metric, value in results[name].items():
+            print(f'  {metric:<24} {value:,.2f}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save-baseline to create one.')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    found = regressions(results, baseline, args.threshold, args.min_ms)
+    for name, metric, base, value in found:
+        print(f'REGRESSION {name} {metric}: {base:,.2f} -> {value:,.2f}')
+    if not found:
+        print(f'No regressions beyond {args.threshold:.0%} of the baseline.')
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
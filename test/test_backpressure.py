@@ -0,0 +1,63 @@
+import pytest
+import main
+from fastapi import HTTPException
+from mqtt_event import MqttEvent
+
+
+@pytest.fixture
+def log(monkeypatch, tmp_path):
+    settings = {'INGEST_HIGH_WATERMARK': 4, 'INGEST_LOW_WATERMARK': 2, 'INGEST_RETRY_AFTER': 7}
+    monkeypatch.setattr(main, 'get_log_setting', lambda log, key, default: settings.get(key, default))
+    monkeypatch.setattr(main, 'schedule_ingest', lambda log: None)
+    monkeypatch.setattr('spill.SPILL_DIR', str(tmp_path))
+    yield 'test/log'
+    main.event_buffers.pop('test/log', None)
+    main.backpressured.discard('test/log')
+    spill = main.spills.pop('test/log', None)
+    if spill is not None:
+        spill.close()
+
+
+def events(count):
+    return [MqttEvent(timestamp=float(i), source='test/log', process='c', activity='a') for i in range(count)]
+
+
+def test_watermarks_have_hysteresis(log):
+    main.add_events_to_queue(events(3), log)
+    assert not main.is_backpressured(log)
+    main.add_events_to_queue(events(1), log)
+    assert main.is_backpressured(log)
+    main.event_buffers[log].take()
+    main.add_events_to_queue(events(3), log)  # Spilled while backpressured
+    assert main.ingest_depth(log) == 3
+    assert main.is_backpressured(log)
+    main.spills[log].read(1)
+    assert not main.is_backpressured(log)
+
+
+def test_backpressured_log_is_rejected_with_retry_after(log):
+    main.add_events_to_queue(events(4), log)
+    with pytest.raises(HTTPException) as e:
+        main.check_backpressure({log: events(1)})
+    assert e.value.status_code == 429 and e.value.headers == {'Retry-After': '7'}
+
+
+def test_events_after_spilled_ones_are_spilled_until_drained(log):
+    main.add_events_to_queue(events(4), log)
+    assert main.is_backpressured(log)
+    main.add_events_to_queue(events(2), log)
+    main.backpressured.discard(log)
+    main.add_events_to_queue(events(1), log)
+    assert len(main.event_buffers[log]) == 4 and len(main.spills[log]) == 3
+    rows = main.spills[log].read(10)
+    assert [row['timestamp'] for row in rows] == [0.0, 1.0, 0.0]
+
+
+def test_all_logs_are_rejected_while_the_event_writer_is_full(log, monkeypatch):
+    monkeypatch.setattr(main.event_writer, 'max_buffered', 2)
+    monkeypatch.setattr(main.event_writer, 'buffer', events(2))
+    with pytest.raises(HTTPException) as e:
+        main.check_backpressure({log: events(1)})
+    assert e.value.status_code == 429 and 'Persisting' in e.value.detail
+    main.event_writer.buffer = events(1)
+    main.check_backpressure({log: events(1)})
@@ -0,0 +1,144 @@
+import asyncio
+import db_helper
+import httpx
+from mqtt_event import MqttEvent
+
+
+def events(count):
+    return [MqttEvent(timestamp=float(i), source='log', process='c', activity=str(i)) for i in range(count)]
+
+
+def test_events_are_added_concurrently_and_only_failed_ones_are_returned(monkeypatch):
+    sent = []
+
+    async def add_event(db_address, event):
+        await asyncio.sleep(0.01 if event.activity == '0' else 0)
+        sent.append(event.activity)
+        return event.activity != '2'
+
+    monkeypatch.setattr(db_helper, 'DB_BATCH_PATH', '')
+    monkeypatch.setattr(db_helper, 'add_event', add_event)
+    batch = events(4)
+    failed = asyncio.run(db_helper.add_events('http://db', batch))
+    assert sent == ['1', '2', '3', '0']
+    assert failed == [batch[2]]
+
+
+class FlakyStore:
+    """Store that only adds the first event of a batch, the first few times events are added."""
+    def __init__(self, failures):
+        self.failures = failures
+        self.added = []
+
+    async def add_events(self, events):
+        if self.failures:
+            self.failures -= 1
+            self.added.extend(events[:1])
+            return events[1:]
+        self.added.extend(events)
+        return []
+
+
+def test_writer_retries_failed_events_before_later_ones(monkeypatch):
+    async def sleep(delay):
+        pass
+
+    monkeypatch.setattr(db_helper.asyncio, 'sleep', sleep)
+    store = FlakyStore(failures=1)
+    writer = db_helper.EventWriter(store, batch_size=2, max_buffered=3)
+    writer.add_many(events(3))
+    assert writer.is_full()
+    asyncio.run(writer.flush())
+    assert [e.activity for e in store.added] == ['0', '1', '2']
+    assert not writer.is_full()
+
+
+def test_watermark_covers_ingested_events_once_they_are_persisted():
+    watermark = db_helper.RowidWatermark()
+    assert watermark.watermark() == 0
+    watermark.ingested(2)
+    assert watermark.watermark() is None
+    watermark.persisted(11)
+    assert watermark.watermark() is None
+    watermark.persisted(12)
+    assert watermark.watermark() == 12
+    watermark.persisted(15)
+    watermark.dropped()
+    watermark.persisted(17)
+    assert watermark.watermark() == 12
+    watermark.ingested(2)
+    assert watermark.watermark() == 15
+    watermark.ingested(1)
+    assert watermark.watermark() == 17
+
+
+def test_writer_holds_back_events_of_a_log_until_it_is_released():
+    store = FlakyStore(failures=0)
+    writer = db_helper.EventWriter(store, max_buffered=3)
+    writer.hold('log')
+    other = MqttEvent(timestamp=0.0, source='other', process='c', activity='x')
+    writer.add_many(events(2) + [other])
+    assert writer.is_full()
+    asyncio.run(writer.flush())
+    assert store.added == [other]
+    writer.release('log')
+    asyncio.run(writer.flush())
+    assert [e.activity for e in store.added] == ['x', '0', '1']
+    assert not writer.is_full()
+
+
+def test_watermark_waits_for_events_with_lower_rowids_than_the_ingested_ones():
+    watermark = db_helper.RowidWatermark()
+    for rowid in (12, 10, 11):
+        watermark.persisted(rowid)
+    watermark.dropped()
+    watermark.ingested(1)
+    assert watermark.watermark() is None
+    watermark.ingested(2)
+    assert watermark.watermark() == 12
+    watermark.ingested(1)
+    assert watermark.watermark() == 12
+
+
+def test_watermark_is_unknown_while_the_store_reports_no_rowids():
+    watermark = db_helper.RowidWatermark()
+    watermark.persisted(None)
+    watermark.ingested(1)
+    assert watermark.watermark() is None
+    watermark.persisted(5)
+    watermark.ingested(1)
+    assert watermark.watermark() == 5
+
+
+def test_writer_tracks_rowids_reported_by_the_store(monkeypatch):
+    async def sleep(delay):
+        pass
+
+    class NumberingStore(FlakyStore):
+        async def add_events(self, events):
+            failed = await super().add_events(events)
+            for event in events:
+                if event not in failed:
+                    event.rowid = 10 + int(event.activity)
+            return failed
+
+    monkeypatch.setattr(db_helper.asyncio, 'sleep', sleep)
+    writer = db_helper.EventWriter(NumberingStore(failures=0), batch_size=2)
+    writer.add_many(events(3))
+    asyncio.run(writer.flush())
+    watermark = writer.get_watermark('log')
+    watermark.ingested(3)
+    assert watermark.watermark() == 12
+
+
+def test_rowids_reported_by_the_db_are_set_on_the_events():
+    batch = events(2)
+    db_helper.set_rowids(batch, httpx.Response(200, json=[7, {'rowid': 8}]))
+    assert [e.rowid for e in batch] == [7, 8]
+    single = events(1)
+    db_helper.set_rowids(single, httpx.Response(200, json={'rowid': 3}))
+    assert single[0].rowid == 3
+    unreported = events(2)
+    db_helper.set_rowids(unreported, httpx.Response(200, text='OK'))
+    db_helper.set_rowids(unreported, httpx.Response(200, json=[1]))
+    assert [e.rowid for e in unreported] == [None, None]
@@ -0,0 +1,40 @@
+import pytest
+from discovery import DfgFilter, ENGINES, discover_petri_net
+
+DFG = {('a', 'b'): 10, ('b', 'c'): 8, ('a', 'c'): 2, ('c', 'd'): 1}
+ACTIVITIES = {'a': 10, 'b': 10, 'c': 10, 'd': 1}
+START_ACT = {'a': 10}
+END_ACT = {'c': 9, 'd': 1}
+
+
+def test_filter_drops_infrequent_activities_and_their_edges():
+    dfg, activities, start_act, end_act = DfgFilter(min_activity_count=2).apply(DFG, ACTIVITIES, START_ACT, END_ACT)
+    assert activities == {'a': 10, 'b': 10, 'c': 10}
+    assert dfg == {('a', 'b'): 10, ('b', 'c'): 8, ('a', 'c'): 2}
+    assert start_act == {'a': 10} and end_act == {'c': 9}
+
+
+def test_filter_keeps_most_frequent_edges():
+    assert DfgFilter(min_edge_count=2).apply(DFG, ACTIVITIES, START_ACT, END_ACT)[0] == \
+        {('a', 'b'): 10, ('b', 'c'): 8, ('a', 'c'): 2}
+    assert DfgFilter(max_edges=2).apply(DFG, ACTIVITIES, START_ACT, END_ACT)[0] == {('a', 'b'): 10, ('b', 'c'): 8}
+    assert DfgFilter(max_activities=2).apply(DFG, ACTIVITIES, START_ACT, END_ACT)[1] == {'a': 10, 'b': 10}
+
+
+def test_default_filter_keeps_everything():
+    assert DfgFilter().apply(DFG, ACTIVITIES, START_ACT, END_ACT) == (DFG, ACTIVITIES, START_ACT, END_ACT)
+
+
+def test_degraded_filter_keeps_a_fraction_of_the_edges():
+    assert DfgFilter().degraded(10, 1, 0.5).max_edges == 5
+    assert DfgFilter().degraded(10, 2, 0.5).max_edges == 3
+    assert DfgFilter().degraded(1, 5, 0.5).max_edges == 1
+    assert DfgFilter(max_edges=2, min_edge_count=3).degraded(10, 1, 0.5).max_edges == 2
+    assert DfgFilter(max_edges=2, min_edge_count=3).degraded(10, 1, 0.5).min_edge_count == 3
+
+
+@pytest.mark.parametrize('engine', sorted(ENGINES))
+def test_engines_discover_a_net_with_all_kept_activities(engine):
+    net, initial, final = discover_petri_net(DFG, ACTIVITIES, START_ACT, END_ACT, engine, DfgFilter(min_activity_count=2))
+    assert {t.label for t in net.transitions if t.label is not None} == {'a', 'b', 'c'}
+    assert len(initial) == 1 and len(final) == 1
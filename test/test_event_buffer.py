@@ -0,0 +1,43 @@
+from event_buffer import EventBuffer, batch_from_rows
+
+
+def decode(batch):
+    return [(t, batch.case_names[c], batch.activity_names[a])
+            for t, c, a in zip(batch.timestamps.tolist(), batch.cases.tolist(), batch.activities.tolist())]
+
+
+def test_take_orders_events_by_timestamp_keeping_arrival_order_of_ties():
+    buffer = EventBuffer()
+    for timestamp, case, activity in [(3, 'c1', 'b'), (1, 'c2', 'a'), (2, 'c1', 'a'), (1, 'c3', 'c'), (2, 'c2', 'b')]:
+        buffer.append(float(timestamp), case, activity)
+    batch = buffer.take()
+    assert decode(batch) == [(1, 'c2', 'a'), (1, 'c3', 'c'), (2, 'c1', 'a'), (2, 'c2', 'b'), (3, 'c1', 'b')]
+    assert len(buffer) == 0 and buffer.take() is None
+
+
+def test_take_interns_cases_per_batch_and_activities_across_batches():
+    buffer = EventBuffer()
+    buffer.append(1.0, 'c1', 'a')
+    first = buffer.take()
+    buffer.append(2.0, 'c2', 'b')
+    buffer.append(3.0, 'c2', 'a')
+    second = buffer.take()
+    assert first.case_names == ['c1'] and second.case_names == ['c2']
+    assert second.activity_names == ['a', 'b'] and second.activities.tolist() == [1, 0]
+    assert decode(second) == [(2, 'c2', 'b'), (3, 'c2', 'a')]
+
+
+def test_rows_keep_the_highest_rowid():
+    batch = batch_from_rows([{'rowid': 2, 'timestamp': '2.5', 'process': 'c', 'activity': 'a'},
+                             {'rowid': 1, 'timestamp': 1, 'process': 'c', 'activity': 'b'}])
+    assert batch.last_rowid == 2
+    assert decode(batch) == [(1, 'c', 'b'), (2.5, 'c', 'a')]
+
+
+def test_invalid_rows_are_skipped():
+    batch = batch_from_rows([{'rowid': 1, 'timestamp': 'noon', 'process': 'c', 'activity': 'a'},
+                             {'rowid': 2, 'timestamp': 2, 'activity': 'a'},
+                             {'rowid': 3, 'timestamp': None, 'process': 'c', 'activity': 'a'},
+                             {'rowid': 4, 'timestamp': 4, 'process': 'c', 'activity': 'b'}])
+    assert batch.last_rowid == 4
+    assert decode(batch) == [(4, 'c', 'b')]
@@ -0,0 +1,125 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from ingest import LiveStreamEngine, DfgAccumulator, WindowedDfgAccumulator, DecayedDfgAccumulator
+from mqtt_event import MqttEvent
+
+
+def append(accumulator, events):
+    """Append events given as (timestamp, case, activity)."""
+    timestamps, cases, activities = zip(*events)
+    accumulator.append_columns(np.asarray(timestamps, dtype=np.float64), list(cases), list(activities))
+
+
+def test_accumulator_links_cases_across_batches():
+    accumulator = DfgAccumulator()
+    append(accumulator, [(1, 'c1', 'a'), (2, 'c2', 'a'), (3, 'c1', 'b')])
+    append(accumulator, [(4, 'c1', 'c'), (5, 'c2', 'b')])
+    dfg, activities, start_act, end_act = accumulator.get()
+    assert dfg == {('a', 'b'): 2, ('b', 'c'): 1}
+    assert activities == {'a': 2, 'b': 2, 'c': 1}
+    assert start_act == {'a': 2}
+    assert end_act == {'b': 1, 'c': 1}
+
+
+def test_accumulator_orders_events_of_a_case_by_timestamp():
+    accumulator = DfgAccumulator()
+    append(accumulator, [(2, 'c1', 'b'), (1, 'c1', 'a')])
+    assert accumulator.get()[0] == {('a', 'b'): 1}
+
+
+def test_evicted_case_counts_as_ended_and_restarts():
+    accumulator = DfgAccumulator(max_open_cases=1)
+    append(accumulator, [(1, 'c1', 'a'), (2, 'c2', 'a')])
+    assert accumulator.count_open_cases() == 1 and accumulator.evicted == 1
+    append(accumulator, [(3, 'c1', 'b')])
+    dfg, _, start_act, end_act = accumulator.get()
+    assert dfg == {}
+    assert start_act == {'a': 2, 'b': 1}
+    assert end_act == {'a': 2, 'b': 1}
+
+
+def test_export_and_import_state_round_trip():
+    accumulator = DfgAccumulator()
+    append(accumulator, [(1, 'c1', 'a'), (2, 'c1', 'b'), (3, 'c2', 'a')])
+    processed, state = accumulator.export_state()
+    restored = DfgAccumulator()
+    restored.import_state(state)
+    append(accumulator, [(4, 'c2', 'c')])
+    append(restored, [(4, 'c2', 'c')])
+    assert restored.get() == accumulator.get()
+    assert processed == 3
+
+
+def test_live_stream_engine_exports_end_activities():
+    engine = LiveStreamEngine()
+    engine.append([MqttEvent(timestamp=t, process=c, activity=a)
+                   for t, c, a in [(1, 'c1', 'a'), (2, 'c1', 'b'), (3, 'c2', 'a')]])
+    engine.live_event_stream.stop()  # Waits until the queued events are processed
+    executor = ThreadPoolExecutor(1)  # A deadlocked export fails the test instead of hanging it
+    try:
+        processed, state = executor.submit(engine.export_state).result(timeout=10)
+    finally:
+        executor.shutdown(wait=False)
+    assert processed == 3
+    assert state['end_activities'] == {'a': 1, 'b': 1}
+    assert engine.count_open_cases() == 2
+
+
+def test_count_window_subtracts_old_events():
+    accumulator = WindowedDfgAccumulator(window_events=2)
+    append(accumulator, [(1, 'c1', 'a'), (2, 'c1', 'b'), (3, 'c1', 'c')])
+    dfg, activities, start_act, end_act = accumulator.get()
+    assert dfg == {('b', 'c'): 1}
+    assert activities == {'b': 1, 'c': 1}
+    assert start_act == {}
+    assert end_act == {'c': 1}
+
+
+def test_time_window_closes_cases_that_left_it():
+    accumulator = WindowedDfgAccumulator(window_seconds=10)
+    append(accumulator, [(1, 'c1', 'a'), (2, 'c2', 'a')])
+    append(accumulator, [(20, 'c3', 'b')])
+    dfg, activities, start_act, end_act = accumulator.get()
+    assert activities == {'b': 1} and start_act == {'b': 1} and end_act == {'b': 1}
+    assert accumulator.count_open_cases() == 1
+
+
+def test_window_removes_end_of_evicted_cases():
+    for accumulator in (WindowedDfgAccumulator(window_seconds=10, max_open_cases=1),
+                        WindowedDfgAccumulator(window_seconds=10, case_ttl=1)):
+        append(accumulator, [(1, 'c1', 'a'), (2, 'c2', 'a'), (4, 'c3', 'a')])
+        assert accumulator.get()[3] == {'a': 3}
+        append(accumulator, [(30, 'c4', 'b')])
+        assert accumulator.get()[3] == {'b': 1}
+        assert accumulator.end_counts.tolist() == [0, 1]
+
+
+def test_window_keeps_end_of_evicted_cases_across_snapshots():
+    accumulator = WindowedDfgAccumulator(window_seconds=10, max_open_cases=1)
+    append(accumulator, [(1, 'c1', 'a'), (2, 'c2', 'b')])
+    restored = WindowedDfgAccumulator(window_seconds=10, max_open_cases=1)
+    restored.import_state(accumulator.export_state()[1])
+    assert restored.get()[3] == {'a': 1, 'b': 1}
+    append(restored, [(30, 'c3', 'c')])
+    assert restored.get()[3] == {'c': 1}
+    assert restored.end_counts.tolist() == [0, 0, 1]
+
+
+def test_decayed_counts_halve_every_half_life():
+    accumulator = DecayedDfgAccumulator(half_life=10)
+    append(accumulator, [(0, 'c1', 'a'), (0, 'c2', 'a'), (0, 'c3', 'a'), (0, 'c4', 'a')])
+    append(accumulator, [(10, 'c5', 'b')])
+    _, activities, start_act, end_act = accumulator.get()
+    assert activities == {'a': 2, 'b': 1}
+    assert start_act == {'a': 2, 'b': 1}
+    assert end_act == {'a': 2, 'b': 1}
+
+
+def test_decayed_end_of_evicted_cases_is_kept():
+    accumulator = DecayedDfgAccumulator(half_life=10, max_open_cases=1)
+    append(accumulator, [(0, 'c1', 'a'), (0, 'c2', 'a'), (0, 'c3', 'a'), (0, 'c4', 'a'), (0, 'c5', 'b')])
+    assert accumulator.get()[3] == {'a': 4, 'b': 1}
+    restored = DecayedDfgAccumulator(half_life=10, max_open_cases=1)
+    restored.import_state(accumulator.export_state()[1])
+    append(restored, [(10, 'c6', 'c')])
+    assert restored.get()[3] == {'a': 2, 'c': 1}
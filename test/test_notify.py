@@ -0,0 +1,34 @@
+import asyncio
+import pytest
+import main
+from fastapi import HTTPException
+
+
+class StreamedRequest:
+    def __init__(self, *chunks: bytes):
+        self.chunks = chunks
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def read(*chunks: bytes):
+    return asyncio.run(main.read_ndjson_events(StreamedRequest(*chunks)))
+
+
+EVENT = b'{"timestamp": 1, "source": "log", "process": "c", "activity": "a"}'
+
+
+def test_events_are_parsed_across_chunks():
+    events = read(EVENT[:10], EVENT[10:] + b'\n\n' + EVENT)
+    assert [e.activity for e in events] == ['a', 'a']
+
+
+def test_invalid_event_reports_its_line_counting_blank_lines():
+    with pytest.raises(HTTPException) as e:
+        read(EVENT + b'\n\n', b'\n{"timestamp": 1}\n' + EVENT)
+    assert e.value.status_code == 400 and 'line 4:' in e.value.detail
+    with pytest.raises(HTTPException) as e:
+        read(b'\n' + EVENT + b'\n', b'{}')
+    assert 'line 3:' in e.value.detail
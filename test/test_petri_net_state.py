@@ -0,0 +1,71 @@
+from petri_net_state import StatePlace, StateTransition, StateEdge, Update, UpdateQueue
+
+
+def update(id, new_places=(), removed_places=(), new_transitions=(), removed_transitions=(), new_edges=(), removed_edges=()):
+    return Update(id, set(new_places), set(removed_places), set(new_transitions), set(removed_transitions),
+                  set(new_edges), set(removed_edges))
+
+
+def test_merge_cancels_added_then_removed_elements():
+    merged = update('1', new_places=[StatePlace('p1', 'a')], new_edges=[StateEdge('e1', 'a', 'b')]) \
+        .merge(update('2', removed_places=[StatePlace('p1', 'a')]))
+    assert merged.id == '2'
+    assert merged.new_places == set() and merged.removed_places == set()
+    assert [e.id for e in merged.new_edges] == ['e1']
+
+
+def test_merge_removes_the_old_id_of_a_readded_element():
+    merged = update('1', removed_transitions=[StateTransition('t1', 'a')]) \
+        .merge(update('2', new_transitions=[StateTransition('t2', 'a')]))
+    assert [t.id for t in merged.removed_transitions] == ['t1']
+    assert [t.id for t in merged.new_transitions] == ['t2']
+
+
+def apply(model, update):
+    """Apply an update to a client model of elements by ID, removals first."""
+    for kind in ('places', 'transitions', 'edges'):
+        for e in getattr(update, f'removed_{kind}'):
+            model.pop(e.id, None)
+        for e in getattr(update, f'new_{kind}'):
+            model[e.id] = e.to_dict()
+    return model
+
+
+def test_merged_update_has_the_same_effect_on_clients_as_the_single_updates():
+    updates = [update('1', removed_places=[StatePlace('p1', 'a')], new_edges=[StateEdge('e2', 'b', 'c')]),
+               update('2', new_places=[StatePlace('p3', 'a')], removed_edges=[StateEdge('e2', 'b', 'c')],
+                      removed_transitions=[StateTransition('t1', 'b')]),
+               update('3', removed_places=[StatePlace('p3', 'a')], new_places=[StatePlace('p4', 'a')],
+                      new_transitions=[StateTransition('t2', 'b')], new_edges=[StateEdge('e3', 'b', 'c')])]
+    initial = {'p1': {'id': 'p1', 'name': 'a'}, 't1': {'id': 't1', 'name': 'b'}}
+    expected = dict(initial)
+    for u in updates:
+        apply(expected, u)
+    queue = UpdateQueue()
+    for u in updates:
+        queue.put(u)
+    assert apply(dict(initial), queue.get()) == expected
+
+
+def test_merge_drops_an_element_that_came_back_unchanged():
+    merged = update('1', removed_edges=[StateEdge('e1', 'a', 'b')]) \
+        .merge(update('2', new_edges=[StateEdge('e1', 'a', 'b')]))
+    assert not merged.is_not_empty()
+
+
+def test_merge_keeps_the_latest_addition():
+    merged = update('1', new_places=[StatePlace('p1', 'a')]) \
+        .merge(update('2', removed_places=[StatePlace('p1', 'a')], new_places=[StatePlace('p2', 'a')]))
+    assert merged.removed_places == set()
+    assert [p.id for p in merged.new_places] == ['p2']
+
+
+def test_update_queue_merges_pending_updates():
+    queue = UpdateQueue()
+    assert queue.empty()
+    queue.put(update('1', new_places=[StatePlace('p1', 'a')]))
+    queue.put(update('2', new_places=[StatePlace('p2', 'b')]))
+    assert queue.qsize() == 1 and queue.merged == 1
+    merged = queue.get()
+    assert merged.id == '2' and {p.id for p in merged.new_places} == {'p1', 'p2'}
+    assert queue.empty()
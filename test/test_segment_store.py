@@ -0,0 +1,86 @@
+import asyncio
+import os
+import pytest
+import segment_store
+from segment_store import SegmentLog, SegmentEventStore
+from mqtt_event import MqttEvent
+
+
+def events(timestamps, log='log'):
+    return [MqttEvent(timestamp=float(t), source=log, process=f'c{t}', activity='a') for t in timestamps]
+
+
+def replay(store, log, **kwargs):
+    async def collect():
+        return [row async for page in store.iterate_events(log, 3, **kwargs) for row in page]
+    return asyncio.run(collect())
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(segment_store, 'SEGMENT_INDEX_INTERVAL', 4)
+    monkeypatch.setattr(segment_store, 'SEGMENT_SIZE', 10 ** 6)
+
+
+def test_append_assigns_consecutive_rowids_across_reopening(tmp_path, small_segments):
+    segment_log = SegmentLog(str(tmp_path), fsync=False)
+    segment_log.append(events(range(5)))
+    segment_log.close()
+    segment_log = SegmentLog(str(tmp_path), fsync=False)
+    assert segment_log.last_rowid == 5 and segment_log.count == 5
+    appended = events([5, 6])
+    segment_log.append(appended)
+    assert segment_log.last_rowid == 7
+    assert [event.rowid for event in appended] == [6, 7]
+
+
+def test_recover_drops_torn_record_after_index_entry(tmp_path, small_segments):
+    segment_log = SegmentLog(str(tmp_path), fsync=False)
+    segment_log.append(events(range(9)))
+    segment_log.close()
+    path = segment_log.path(1, 'seg')
+    os.truncate(path, os.path.getsize(path) - 1)
+
+    segment_log = SegmentLog(str(tmp_path), fsync=False)
+    assert segment_log.last_rowid == 8 and segment_log.count == 8
+    assert segment_log.read_index(1)['rowid'].tolist() == [1, 5]
+    segment_log.append(events([9]))
+    assert segment_log.read_index(1)['rowid'].tolist() == [1, 5, 9]
+    segment_log.close()
+
+    store = SegmentEventStore(str(tmp_path.parent))
+    rows = replay(store, tmp_path.name)
+    assert [row['rowid'] for row in rows] == list(range(1, 10))
+
+
+def test_recover_rebuilds_missing_index_entries(tmp_path, small_segments):
+    segment_log = SegmentLog(str(tmp_path), fsync=False)
+    segment_log.append(events(range(9)))
+    segment_log.close()
+    os.truncate(segment_log.path(1, 'idx'), segment_store.INDEX_ENTRY.size)
+    segment_log = SegmentLog(str(tmp_path), fsync=False)
+    assert segment_log.last_rowid == 9
+    assert segment_log.read_index(1)['rowid'].tolist() == [1, 5, 9]
+
+
+def test_replay_plan_starts_at_last_index_entry_before_rowid(tmp_path, small_segments):
+    segment_log = SegmentLog(str(tmp_path), fsync=False)
+    segment_log.append(events(range(10)))
+    offsets = segment_log.read_index(1)['offset'].tolist()
+    assert segment_log.replay_plan(0) == ([(1, 0, segment_log.size)], 10)
+    assert segment_log.replay_plan(4) == ([(1, offsets[1], segment_log.size)], 10)
+    assert segment_log.replay_plan(6) == ([(1, offsets[1], segment_log.size)], 10)
+    assert segment_log.replay_plan(8) == ([(1, offsets[2], segment_log.size)], 10)
+
+
+def test_replay_plan_spans_segments(tmp_path, small_segments, monkeypatch):
+    monkeypatch.setattr(segment_store, 'SEGMENT_SIZE', 1)
+    segment_log = SegmentLog(str(tmp_path), fsync=False)
+    segment_log.append(events(range(3)))
+    assert segment_log.segments == [1, 2, 3]
+    plan, end_rowid = segment_log.replay_plan(1)
+    assert [segment for segment, _, _ in plan] == [2, 3] and end_rowid == 3
+    segment_log.close()
+
+    store = SegmentEventStore(str(tmp_path.parent))
+    assert [row['rowid'] for row in replay(store, tmp_path.name, after_rowid=1)] == [2, 3]
@@ -0,0 +1,20 @@
+import os
+import spill
+from spill import SpillSegment
+from mqtt_event import MqttEvent
+
+
+def test_read_returns_events_in_order_and_skips_invalid_lines(monkeypatch, tmp_path):
+    monkeypatch.setattr(spill, 'SPILL_DIR', str(tmp_path))
+    segment = SpillSegment('a/b')
+    assert os.path.basename(segment.file_name) == 'a%2Fb.ndjson'
+    segment.append([MqttEvent(timestamp=1.0, source='a/b', process='c1', activity='x')])
+    segment.file.write(b'{"timestamp":\n')
+    segment.pending += 1
+    segment.append([MqttEvent(timestamp=2.0, source='a/b', process='c2', activity='y')])
+    assert len(segment) == 3
+    assert segment.read(2) == [{'timestamp': 1.0, 'process': 'c1', 'activity': 'x'}]
+    assert segment.read(2) == [{'timestamp': 2.0, 'process': 'c2', 'activity': 'y'}]
+    assert len(segment) == 0 and os.path.getsize(segment.file_name) == 0
+    segment.close()
+    assert not os.path.exists(segment.file_name)
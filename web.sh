@@ -0,0 +1,13 @@
+#!/bin/sh
+# Runs the miner process and the web workers in one dyno. The miner process only listens on localhost, where the
+# web workers forward to it, and is restarted whenever it exits.
+cd "$(dirname "$0")/src" || exit 1
+MINER_PORT=${MINER_PORT:-8002}
+(
+  while true; do
+    MINER_MODE=embedded uvicorn main:app --host 127.0.0.1 --port "$MINER_PORT"
+    echo "Miner process exited with status $?, restarting it" >&2
+    sleep 1
+  done
+) &
+MINER_MODE=web MINER_ADDRESS="http://127.0.0.1:$MINER_PORT" exec gunicorn -w 4 -k uvicorn.workers.UvicornWorker main:app